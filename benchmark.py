@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmarks for the hot paths of the emulator, from packet building up to a full poll cycle
+# against local stand-in devices.
+# Usage: python3 benchmark.py [--save] [--baseline FILE] [--capture FILE] [name ...]   (no name = run all)
+# Results are compared with the baseline file (if there is one), --save stores them as new baseline.
+# Baselines are only comparable on the same host and Python version.
+
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import itertools
+import tracemalloc
+from sma_speedwire import SMA_SPEEDWIRE, SMA_PKT_HEADER, SMA_ESIGNATURE, COMMAND_LIST
+from emeter2 import emeterPacket, emeterFrame
+from speedwiredecoder import decode_speedwire, speedwire_serial
+from simulator import FakeInverter, InverterFarm, FakeMeter, MeterFarm, FakeDTU, inverter_reply
+
+METER_SN = 1900888888
+BASELINE_FILE = "benchmark_baseline.json"
+REGRESSION_LIMIT = 0.25  # report a regression if ops/s drop or p50 grows by more than this (see --limit)
+
+results = {}
+capture_file = None  # recorded traffic (see capture.py), used for the decode benchmarks if given
+
+def measure(func, number=20000, calls=1000):
+    """Returns {ops: ops per second, allocs: allocated blocks kept per call, peak: peak bytes allocated per call,
+    p50/p99: latency of one call in microseconds} of func()."""
+    for _ in range(min(number, 100)):
+        func()
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    ops = number / (time.perf_counter() - start)
+
+    latencies = []
+    for _ in range(min(number, 10000)):
+        start = time.perf_counter_ns()
+        func()
+        latencies.append(time.perf_counter_ns() - start)
+    latencies.sort()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    keep = [func() for _ in range(calls)]  # keep results alive, so their allocations are counted
+    after = tracemalloc.take_snapshot()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    del keep
+    peak = 0
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        func()
+        peak += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return {
+        "ops": ops,
+        "allocs": blocks / calls,
+        "peak": peak / calls,
+        "p50": latencies[len(latencies) // 2] / 1000,
+        "p99": latencies[int(len(latencies) * 0.99)] / 1000,
+    }
+
+def report(name, func, number=20000, calls=1000):
+    result = results[name] = measure(func, number, calls)
+    print(f"{name:<32} {result['ops']:>10.0f} ops/s {result['p50']:>9.1f} us p50 {result['p99']:>9.1f} us p99"
+          f" {result['allocs']:>7.1f} allocs/call {result['peak']:>8.0f} B peak/call")
+    return result["ops"]
+
+def compare(baseline, limit=REGRESSION_LIMIT):
+    """Prints the change against the baseline, returns the names of regressed benchmarks.
+    p50 is used for latency, p99 is too noisy on a busy host to judge a single run."""
+    regressed = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        ops = result["ops"] / base["ops"] - 1
+        p50 = result["p50"] / base["p50"] - 1
+        p99 = result["p99"] / base["p99"] - 1
+        flag = ""
+        if ops < -limit or p50 > limit:
+            flag = "  REGRESSION"
+            regressed.append(name)
+        print(f"{name:<32} {ops:>+10.1%} ops/s {p50:>+9.1%} p50 {p99:>+9.1%} p99{flag}")
+    return regressed
+
+def legacy_packet(dev, cmd):
+    # request building as done before the templates, kept as reference
+    dev.pkt_id = (dev.pkt_id + 1) & 0x7FFF
+    commands = COMMAND_LIST[cmd]
+    sep2 = bytes([0x00, 0x00])
+    sep4 = bytes([0x00, 0x00, 0x00, 0x00])
+    data = sep4
+    esignature = bytes.fromhex(SMA_ESIGNATURE + "09A0")
+    if cmd == "login":
+        sep2 = bytes([0x00, 0x01])
+        esignature = bytes.fromhex(SMA_ESIGNATURE + "0EA0")
+        encpasswd = [0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88]
+        encpasswd[0:len(dev.password)] = [((0x88 + ord(char)) & 0xff) for char in dev.password]
+        data = int(time.time()).to_bytes(4, byteorder='little')
+        data += sep4 + bytes(encpasswd) + sep4
+    elif cmd == "logout":
+        sep2 = bytes([0x00, 0x03])
+        esignature = bytes.fromhex(SMA_ESIGNATURE + "08A0")
+        data = bytes([])
+    msg = bytes.fromhex(SMA_PKT_HEADER) + bytes([0x00, 0x00]) + esignature
+    msg += dev.target_id + sep2 + dev.my_id + sep2
+    msg += sep4 + (dev.pkt_id | 0x8000).to_bytes(2, byteorder='little')
+    msg += commands[0].to_bytes(4, byteorder='little')
+    msg += commands[1].to_bytes(4, byteorder='little')
+    msg += commands[2].to_bytes(4, byteorder='little')
+    msg += data
+    pkt_len = (len(msg)-20).to_bytes(2, byteorder='big')
+    msg = msg[:12] + pkt_len + msg[14:]
+    dev.logger.debug("> %s", msg.hex())
+    return msg
+
+def bench_packet():
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.INFO)
+    dev = SMA_SPEEDWIRE("127.0.0.1", "0000", logger=logger)
+    for cmd in ("login", "energy"):
+        legacy = report(f"packet {cmd} (legacy)", lambda: legacy_packet(dev, cmd))
+        # template is patched in place, copy it like the shared transport does before queueing
+        templ = report(f"packet {cmd} (template)", lambda: bytes(dev._packet(cmd)))
+        print(f"{'':<32} {templ / legacy:>10.1f}x")
+    dev.sock.close()
+
+def legacy_emeter(psupply, psupplycounter):
+    # frame building as done before emeterFrame (new packet, every value written one by one)
+    packet = emeterPacket(METER_SN)
+    packet.begin(int(time.time() * 1000))
+    for id in emeterFrame.SMA_EM_CHANNELS:
+        if id == emeterPacket.SMA_NEGATIVE_ACTIVE_POWER:
+            packet.addMeasurementValue(id, round(psupply * 10))
+        elif id == emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY:
+            packet.addCounterValue(id, round(psupplycounter * 1000 * 3600))
+        elif emeterFrame.isCounter(id):
+            packet.addCounterValue(id, 0)
+        else:
+            packet.addMeasurementValue(id, 0)
+    packet.end()
+    return packet.getData()[:packet.getLength()]
+
+def bench_emeter():
+    frame = emeterFrame(METER_SN)
+    def build(psupply, psupplycounter):
+        frame.setTimestamp(int(time.time() * 1000))
+        frame.setMeasurementValue(emeterPacket.SMA_NEGATIVE_ACTIVE_POWER, round(psupply * 10))
+        frame.setCounterValue(emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY, round(psupplycounter * 1000 * 3600))
+        return frame.getData()
+    legacy = report("emeter frame (legacy)", lambda: legacy_emeter(7893.2, 117182.192), 2000)
+    templ = report("emeter frame (template)", lambda: build(7893.2, 117182.192))
+    print(f"{'':<32} {templ / legacy:>10.1f}x")
+    import inverter_emeter
+    result = inverter_emeter.build_result(7893.2, 117182.192)
+    report("parse_and_emulate", lambda: inverter_emeter.parse_and_emulate(result, NullSocket()))
+
+class NullSocket:
+    # takes the place of the multicast socket, so only frame building is measured
+    def sendto(self, data, address):
+        return len(data)
+
+def sample_frame():
+    # frame as sent by a real meter, all channels filled
+    frame = emeterFrame(1900123456)
+    frame.setTimestamp(123456789)
+    for i, id in enumerate(frame.offsets):
+        frame.setValue(id, 1000 * i + 7)
+    return bytes(frame.getData())
+
+def recorded_frames():
+    from capture import read_capture, KIND_EMETER
+    frames = [payload for kind, _, _, payload in read_capture(capture_file) if kind == KIND_EMETER]
+    if not frames:
+        raise SystemExit(f"{capture_file} contains no Energy Meter frames")
+    return frames
+
+def bench_decode():
+    if capture_file:
+        # cycle through the recorded frames
+        frames = recorded_frames()
+        data = itertools.cycle(frames).__next__
+        suffix = f", {len(frames)} recorded"
+    else:
+        frame = sample_frame()
+        data = lambda: frame
+        suffix = ""
+    report(f"decode_speedwire (all{suffix})", lambda: decode_speedwire(data()))
+    channels = {'psupply', 'psupplycounter', 'pconsume', 'pconsumecounter'}
+    report(f"decode_speedwire (4 channels{suffix})", lambda: decode_speedwire(data(), channels))
+    wanted = {1900000001, 1900000002}
+    report(f"speedwire_serial (dropped{suffix})", lambda: speedwire_serial(data()) in wanted, 100000)
+
+def bench_replay():
+    # full replay of the recorded traffic through decoder, parser and aggregate()
+    import capture
+    if not capture_file:
+        print("replay: needs --capture FILE")
+        return
+    logging.getLogger().setLevel(logging.CRITICAL)
+    records = sum(1 for _ in capture.read_capture(capture_file))
+    ops = report(f"replay ({records} records)", lambda: capture.replay(capture_file), 20, 5)
+    print(f"{'':<32} {ops * records:>10.0f} records/s")
+
+def bench_parse():
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.INFO)
+    dev = SMA_SPEEDWIRE("127.0.0.1", "0000", logger=logger)
+    for cmd in ("energy", "power_ac_total", "spot_ac", "status"):
+        reply = inverter_reply(dev._packet(cmd))
+        report(f"_parse {cmd}", lambda: dev._parse(reply))
+    dev.sock.close()
+
+def bench_cycle(inverters=3, dtus=1, number=500):
+    # poll_cycle() of inverter_emeter with simulated inverters, DTUs and one Energy Meter on localhost
+    import inverter_emeter as ie
+    from sma_speedwire import SpeedwireTransport
+    from emeter_receiver import EmeterReceiver
+    from json_source import JsonSource, OPENDTU_FIELDS
+    from energy_store import EnergyStateStore
+    from poller import PollEngine
+    from scheduler import DeviceScheduler
+
+    ie.ENABLE_KNX = False
+    ie.energy_state = EnergyStateStore("/tmp/benchmark_energy.json", interval=3600)
+    fake_inverters = [FakeInverter(serial=2001000000 + n) for n in range(inverters)]
+    farm = InverterFarm(fake_inverters)
+    farm.start()
+    fake_dtus = [FakeDTU().start() for _ in range(dtus)]
+
+    ie.speedwire_transport = SpeedwireTransport()
+    ie.sma_devices = []
+    for inverter in fake_inverters:
+        dev = ie.SMA_SPEEDWIRE(inverter.host, "0000", session=True, transport=ie.speedwire_transport)
+        dev.port = inverter.port
+        dev.init()
+        key = f"{inverter.host}:{inverter.port}"
+        ie.sma_state[key] = {"last_power": 0.0}
+        ie.sma_devices.append((key, 15000, dev))
+    ie.json_sources = [JsonSource(dtu.url, label="Hoymiles", **OPENDTU_FIELDS) for dtu in fake_dtus]
+    for source in ie.json_sources:
+        ie.hoymiles_state[source.url] = {"last_power": 0.0, "last_energy": 0.0, "timeouts": 0}
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    ie.emeter_receiver = EmeterReceiver(sock, ie.CONSUME_METERS, ie.METER_CHANNELS)
+    ie.emeter_receiver.start()
+    meters = MeterFarm([FakeMeter(ie.CONSUME_METERS[0])], sock.getsockname())
+    meters.start()
+    time.sleep(0.1)
+
+    ie.poll_engine = PollEngine(ie.POLL_WORKERS)
+    ie.poll_scheduler = DeviceScheduler()
+    for key in [key for key, _, _ in ie.sma_devices] + [source.url for source in ie.json_sources]:
+        ie.poll_scheduler.add(key, 0)  # every device in every cycle
+    try:
+        # allocations also include the transport, receiver and simulator threads
+        report(f"poll_cycle ({inverters} SMA, {dtus} DTU)", ie.poll_cycle, number, min(number, 100))
+    finally:
+        meters.stop()
+        ie.emeter_receiver.stop()
+        ie.poll_engine.shutdown()
+        ie.speedwire_transport.close()
+        farm.stop()
+        for dtu in fake_dtus:
+            dtu.stop()
+
+BENCHMARKS = {
+    "packet": bench_packet,
+    "parse": bench_parse,
+    "emeter": bench_emeter,
+    "decode": bench_decode,
+    "cycle": bench_cycle,
+    "scale": lambda: bench_cycle(200, 20, 50),
+    "replay": bench_replay,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the emulator hot paths")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline file (default: %(default)s)")
+    parser.add_argument("--limit", type=float, default=REGRESSION_LIMIT, help="allowed slowdown (default: %(default)s)")
+    parser.add_argument("--save", action="store_true", help="store the results as new baseline")
+    parser.add_argument("--capture", help="capture file (see capture.py) with recorded traffic for decode and replay")
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(sorted(unknown))}")
+
+    global capture_file
+    capture_file = args.capture
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=1)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if baseline:
+        print(f"\nCompared with {args.baseline}:")
+        if compare(baseline, args.limit):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Records received traffic (Energy Meter datagrams, speedwire answers, JSON payloads and the result of
+# every poll cycle) into a binary capture file and replays it offline through the decoder, the speedwire
+# parser and aggregate() of inverter_emeter.
+#
+# File format: MAGIC, then records of
+#   kind (1 byte), time in seconds since start of the recording (double), key length (1 byte),
+#   payload length (4 bytes), key (utf-8, IP/URL/sender), payload
+# all numbers big endian.
+#
+# Usage: python3 capture.py info FILE
+#        python3 capture.py replay FILE [--realtime] [--decode-only]
+
+import sys
+import json
+import time
+import struct
+import logging
+import argparse
+import threading
+
+MAGIC = b"SMACAP1\n"
+KIND_EMETER = 1     # Energy Meter multicast datagram, no key
+KIND_SPEEDWIRE = 2  # speedwire answer of an inverter, key = inverter host
+KIND_JSON = 3       # JSON payload, key = URL
+KIND_CYCLE = 4      # result of a poll cycle (JSON), for comparison on replay
+KIND_STATE = 5      # energy state at the start of the recording (JSON)
+KIND_POLL = 6       # outcome of the device polls of a cycle (JSON {key: [status, error message]})
+KIND_NAMES = {KIND_EMETER: "emeter", KIND_SPEEDWIRE: "speedwire", KIND_JSON: "json", KIND_CYCLE: "cycle", KIND_STATE: "state",
+              KIND_POLL: "poll"}
+
+RECORD_HEADER = struct.Struct(">BdBI")
+
+class CaptureWriter:
+    """Appends records to a capture file, can be shared by all threads."""
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.records = 0
+
+    def write(self, kind, key, payload):
+        key = str(key).encode()[:255]
+        header = RECORD_HEADER.pack(kind, time.monotonic() - self.start, len(key), len(payload))
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(header)
+            self.file.write(key)
+            self.file.write(payload)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+def read_capture(path):
+    """Yields (kind, time, key, payload) of all records in the capture file."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is no capture file")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return  # end of file (or cut off while recording)
+            kind, timestamp, key_length, payload_length = RECORD_HEADER.unpack(header)
+            key = f.read(key_length).decode()
+            payload = f.read(payload_length)
+            if len(payload) < payload_length:
+                return
+            yield kind, timestamp, key, payload
+
+def replay(path, realtime=False, decode_only=False, logger=None):
+    """Replays a capture, returns a dict with counters and the number of cycles whose result differs
+    from the recorded one. Uses the device configuration of inverter_emeter."""
+    import inverter_emeter as ie
+    from speedwiredecoder import decode_speedwire, speedwire_serial
+    from energy_store import EnergyStateStore
+    from poller import POLL_OK, POLL_ERROR, POLL_LATE
+
+    logger = logger or logging.getLogger(__name__)
+    stats = {name: 0 for name in KIND_NAMES.values()}
+    stats["cycles_differ"] = 0
+    if not decode_only:
+        # devices only parse the recorded answers, the energy state starts empty and is never written
+        ie.energy_state = EnergyStateStore("/dev/null")
+        ie.sma_devices = [(ip, max_watt, ie.SMA_SPEEDWIRE(ip, pwd, logger=logger)) for ip, pwd, max_watt in ie.inverters]
+    devices = {ip: dev for ip, _, dev in ie.sma_devices} if not decode_only else {}
+    sources = {source.url: source for source in ie.json_sources} if not decode_only else {}
+    frames = {}     # serial -> (values, time)
+    payloads = {}   # url -> last JSON payload
+    poll_results = None
+
+    wall_start = time.monotonic()
+    for kind, timestamp, key, payload in read_capture(path):
+        name = KIND_NAMES.get(kind, "unknown")
+        stats[name] = stats.get(name, 0) + 1
+        if realtime:
+            delay = wall_start + timestamp - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if kind == KIND_EMETER:
+            sn = speedwire_serial(payload)
+            if decode_only:
+                decode_speedwire(payload)
+            elif sn in ie.wanted_meters:
+                frames[sn] = (decode_speedwire(payload, ie.METER_CHANNELS), timestamp)
+        if decode_only:
+            continue
+
+        if kind == KIND_STATE:
+            ie.energy_state.values = json.loads(payload)
+        elif kind == KIND_SPEEDWIRE:
+            dev = devices.get(key)
+            if dev is None:
+                # inverter found by discovery while recording
+                dev = devices[key] = ie.SMA_SPEEDWIRE(key, ie.SMA_DISCOVERY_PASSWORD, logger=logger)
+                ie.sma_state.setdefault(key, {"last_power": 0.0})
+                ie.sma_devices.append((key, ie.SMA_DISCOVERY_MAX_WATT, dev))
+            # answers only update the device, whether its poll succeeded is taken from the poll record
+            try:
+                dev._parse(dev._check_response(payload))
+            except Exception as e:
+                logger.debug(f"Answer of {key} at {timestamp:.3f}s: {e}")
+        elif kind == KIND_JSON:
+            payloads[key] = payload
+        elif kind == KIND_POLL:
+            # devices without recorded outcome were not polled in this cycle or did not answer in time
+            outcomes = json.loads(payload)
+            poll_results = {}
+            for key in list(devices) + list(sources):
+                status, error = outcomes.get(key, (POLL_LATE, None))
+                if status == POLL_OK:
+                    try:
+                        value = ie.sma_values(devices[key]) if key in devices else sources[key].parse(json.loads(payloads[key]))
+                    except Exception as e:
+                        status, error = POLL_ERROR, e
+                if status == POLL_OK:
+                    poll_results[key] = (POLL_OK, value, 0.0)
+                else:
+                    poll_results[key] = (status, Exception(error) if status == POLL_ERROR else None, 0.0)
+        elif kind == KIND_CYCLE and poll_results is not None:
+            recorded = json.loads(payload)
+            snapshot = {sn: (dict(values), timestamp - received) for sn, (values, received) in frames.items()}
+            values, _, _ = ie.aggregate(poll_results, snapshot)
+            result = ie.values_result(values)
+            if (result["psupply"], result["psupplycounter"]) != (recorded["psupply"], recorded["psupplycounter"]):
+                stats["cycles_differ"] += 1
+                logger.warning(f"Cycle at {timestamp:.3f}s: replayed P={result['psupply']}W E={result['psupplycounter']}kWh, "
+                               f"recorded P={recorded['psupply']}W E={recorded['psupplycounter']}kWh")
+            poll_results = None
+    stats["seconds"] = time.monotonic() - wall_start
+    for dev in devices.values():
+        dev.close()
+    return stats
+
+def info(path):
+    counts = {}
+    first = last = None
+    for kind, timestamp, key, payload in read_capture(path):
+        name = KIND_NAMES.get(kind, f"unknown {kind}")
+        count, size = counts.get(name, (0, 0))
+        counts[name] = (count + 1, size + len(payload))
+        first = timestamp if first is None else first
+        last = timestamp
+    print(f"{path}: {0 if first is None else last - first:.1f}s")
+    for name, (count, size) in sorted(counts.items()):
+        print(f"{name:<10} {count:>10} records {size:>12} bytes")
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay a capture file")
+    parser.add_argument("command", choices=("info", "replay"))
+    parser.add_argument("file")
+    parser.add_argument("--realtime", action="store_true", help="replay with the recorded timing (default: as fast as possible)")
+    parser.add_argument("--decode-only", action="store_true", help="only decode the Energy Meter datagrams")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        info(args.file)
+        return 0
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    stats = replay(args.file, args.realtime, args.decode_only)
+    records = sum(stats[name] for name in KIND_NAMES.values())
+    print(f"{records} records in {stats['seconds']:.3f}s ({records / max(stats['seconds'], 1e-9):.0f} records/s)")
+    print(", ".join(f"{name}: {stats[name]}" for name in KIND_NAMES.values()))
+    if not args.decode_only:
+        print(f"cycles with a different result: {stats['cycles_differ']}")
+    return 1 if stats["cycles_differ"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+import threading
+from energy_store import write_json
+
+class DeviceRegistry:
+    """Speedwire devices seen before, by IP: serial, susyid, inv_type, inv_class, whether the device was found
+    by discovery (not configured) and when it was last seen. Saved as JSON file, so after a restart known devices
+    need no info request and discovered devices are used without waiting for the next discovery."""
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger(__name__)
+        self.devices = {}
+        self.dirty = False
+        self.lock = threading.Lock()    # discovery runs in its own thread
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    self.devices = json.load(f)
+        except Exception as e:
+            self.logger.error(f"Failed to load device registry: {e}")
+        return self
+
+    def get(self, ip):
+        with self.lock:
+            return self.devices.get(ip)
+
+    def discovered(self, classes=None):
+        """IPs of the discovered devices (of inv_class in classes)."""
+        with self.lock:
+            return [ip for ip, info in self.devices.items()
+                    if info.get("discovered") and (classes is None or info.get("inv_class") in classes)]
+
+    def remember(self, ip, dev, discovered=False):
+        """Stores the identity of dev (SMA_SPEEDWIRE after init())."""
+        info = {"serial": dev.serial, "susyid": dev.susyid, "inv_type": dev.inv_type, "inv_class": dev.inv_class,
+                "discovered": discovered, "seen": int(time.time())}
+        with self.lock:
+            self.devices[ip] = info
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return False
+            try:
+                write_json(self.path, self.devices)
+            except Exception as e:
+                self.logger.error(f"Failed to save device registry: {e}")
+                return False
+            self.dirty = False
+            return True
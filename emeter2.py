@@ -1,3 +1,5 @@
+from struct import pack_into
+
 class emeterPacket:
     SMA_POSITIVE_ACTIVE_POWER = 0x00010400
     SMA_POSITIVE_ACTIVE_POWER_L1 = 0x00150400
@@ -146,3 +148,72 @@ class emeterPacket:
         pSerNo = self.offsetOf(self.meterPacket, DSRC, self._headerLength)
         self.storeU32BE(pSerNo, serNo)
 
+
+class emeterFrame:
+    """Precompiled emeter frame: header, OBIS ids and version are written once,
+    afterwards only timestamp and values are patched in at their known offsets."""
+
+    # layout of a full SMA energy meter frame (same order as sent by a real meter)
+    SMA_EM_CHANNELS = (
+        emeterPacket.SMA_POSITIVE_ACTIVE_POWER, emeterPacket.SMA_POSITIVE_ACTIVE_ENERGY,
+        emeterPacket.SMA_NEGATIVE_ACTIVE_POWER, emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY,
+        emeterPacket.SMA_POSITIVE_REACTIVE_POWER, emeterPacket.SMA_POSITIVE_REACTIVE_ENERGY,
+        emeterPacket.SMA_NEGATIVE_REACTIVE_POWER, emeterPacket.SMA_NEGATIVE_REACTIVE_ENERGY,
+        emeterPacket.SMA_POSITIVE_APPARENT_POWER, emeterPacket.SMA_POSITIVE_APPARENT_ENERGY,
+        emeterPacket.SMA_NEGATIVE_APPARENT_POWER, emeterPacket.SMA_NEGATIVE_APPARENT_ENERGY,
+        emeterPacket.SMA_POWER_FACTOR,
+    ) + tuple(
+        getattr(emeterPacket, name + phase) for phase in ("_L1", "_L2", "_L3") for name in (
+            "SMA_POSITIVE_ACTIVE_POWER", "SMA_POSITIVE_ACTIVE_ENERGY",
+            "SMA_NEGATIVE_ACTIVE_POWER", "SMA_NEGATIVE_ACTIVE_ENERGY",
+            "SMA_POSITIVE_REACTIVE_POWER", "SMA_POSITIVE_REACTIVE_ENERGY",
+            "SMA_NEGATIVE_REACTIVE_POWER", "SMA_NEGATIVE_REACTIVE_ENERGY",
+            "SMA_POSITIVE_APPARENT_POWER", "SMA_POSITIVE_APPARENT_ENERGY",
+            "SMA_NEGATIVE_APPARENT_POWER", "SMA_NEGATIVE_APPARENT_ENERGY",
+            "SMA_VOLTAGE", "SMA_CURRENT", "SMA_POWER_FACTOR",
+        )
+    )
+
+    def __init__(self, serNo, channels=SMA_EM_CHANNELS):
+        # let emeterPacket build the frame once with all values 0
+        packet = emeterPacket(serNo)
+        packet.begin(0)
+        self.offsets = {}
+        self.counters = set()
+        for id in channels:
+            self.offsets[id] = packet._pPacketPos + 4
+            if self.isCounter(id):
+                self.counters.add(id)
+                packet.addCounterValue(id, 0)
+            else:
+                packet.addMeasurementValue(id, 0)
+        length = packet.end()
+        self._timeOffset = packet._pMeterTime
+        self.frame = bytearray(packet.getData()[:length])
+        self.view = memoryview(self.frame)
+
+    @staticmethod
+    def isCounter(id):
+        return (id >> 8) & 0xFF == 0x08
+
+    def setTimestamp(self, timeStampMs):
+        pack_into(">I", self.frame, self._timeOffset, timeStampMs & 0xFFFFFFFF)
+
+    def setMeasurementValue(self, id, value):
+        pack_into(">I", self.frame, self.offsets[id], value & 0xFFFFFFFF)
+
+    def setCounterValue(self, id, value):
+        pack_into(">Q", self.frame, self.offsets[id], value & 0xFFFFFFFFFFFFFFFF)
+
+    def setValue(self, id, value):
+        if id in self.counters:
+            self.setCounterValue(id, value)
+        else:
+            self.setMeasurementValue(id, value)
+
+    def getData(self):
+        # memoryview on the frame, can be passed to sendto() without copying
+        return self.view
+
+    def getLength(self):
+        return len(self.frame)
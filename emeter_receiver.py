@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import logging
+import threading
+from speedwiredecoder import decode_speedwire, speedwire_serial
+
+class EmeterReceiver(threading.Thread):
+    """Drains the Energy Meter multicast socket in the background.
+    Only the latest frame of every wanted meter is kept together with its receive time,
+    frames are decoded on demand by snapshot()."""
+
+    def __init__(self, sock, serials, channels=None, logger=None):
+        super().__init__(name="emeter-recv", daemon=True)
+        self.sock = sock
+        self.serials = set(serials)
+        self.channels = channels
+        self.logger = logger or logging.getLogger(__name__)
+        self.latest = {}    # serial -> (frame, time.monotonic() of reception)
+        self.decoded = {}   # serial -> (frame, decoded values), decode cache for snapshot()
+        self.received = {}  # serial -> number of frames kept
+        self.dropped = {}   # serial (None = no SMA frame) -> number of frames of other devices
+        self.recorder = None  # function(data), called with every datagram (see capture.py)
+        self.running = True
+
+    def run(self):
+        self.sock.settimeout(1.0)
+        buf = bytearray(2048)
+        view = memoryview(buf)
+        while self.running:
+            try:
+                size = self.sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if self.running:
+                    self.logger.error(f"[EnergyMeter] Error while reading socket: {e}")
+                    time.sleep(1.0)
+                continue
+            if self.recorder:
+                self.recorder(view[:size])
+            # frames of other devices are dropped without copying or decoding them
+            sn = speedwire_serial(view[:size])
+            if sn in self.serials:
+                self.latest[sn] = (bytes(view[:size]), time.monotonic())
+                self.received[sn] = self.received.get(sn, 0) + 1
+            else:
+                self.dropped[sn] = self.dropped.get(sn, 0) + 1
+
+    def snapshot(self, max_age=None):
+        """Returns {serial: (values, age in seconds)} of all meters heard so far,
+        meters older than max_age seconds are left out. values is a new dict on every call."""
+        now = time.monotonic()
+        result = {}
+        for sn, (frame, received) in list(self.latest.items()):
+            age = now - received
+            if max_age is not None and age > max_age:
+                continue
+            cached = self.decoded.get(sn)
+            if cached is None or cached[0] is not frame:
+                cached = self.decoded[sn] = (frame, decode_speedwire(frame, self.channels))
+            result[sn] = (dict(cached[1]), age)
+        return result
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+
+def write_json(path, data):
+    """Writes data as JSON to a temp file, syncs it and renames it over path."""
+    tmp = path + ".tmp"
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    # make the rename itself persistent
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class EnergyStateStore:
+    """Last known energy counter per device (by IP, URL or serial), persisted as JSON file.
+    Setting an unchanged value does not make the store dirty, flush() writes only if something
+    changed and at most every <interval> seconds (less SD card writes).
+    The file is written to a temp file, synced and renamed over the old one, so after a power cut
+    there is always either the old or the new complete file."""
+
+    def __init__(self, path, interval=300, logger=None):
+        self.path = path
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.values = {}
+        self.dirty = set()
+        self.last_flush = time.monotonic()
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    self.values = json.load(f)
+        except Exception as e:
+            self.logger.error(f"Failed to load energy state: {e}")
+        self.dirty.clear()
+        return self
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        if self.values.get(key) != value:
+            self.values[key] = value
+            self.dirty.add(key)
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def flush(self, force=False):
+        if not self.dirty:
+            return False
+        if not force and time.monotonic() - self.last_flush < self.interval:
+            return False
+        try:
+            write_json(self.path, self.values)
+        except Exception as e:
+            self.logger.error(f"Failed to save energy state: {e}")
+            return False
+        self.dirty.clear()
+        self.last_flush = time.monotonic()
+        return True
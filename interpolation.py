@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+class EnergyInterpolator:
+    """Smooth energy counter (kWh) of one device between polls.
+    The value is the last real counter plus the power integrated over time since that counter
+    changed, so the counter grows on every emit instead of jumping when the inverter reports a new value.
+    A new real counter re-anchors the integration. The value never goes backwards: if the estimate ran ahead
+    of the real counter, it holds until the real counter catches up. It never runs more than <limit> kWh ahead."""
+
+    def __init__(self, limit=1.0):
+        self.limit = limit
+        self.real = None        # last real counter
+        self.integrated = 0.0   # kWh since the real counter changed
+        self.value = None
+        self.last_time = None
+
+    def update(self, power, energy, now):
+        """Returns the interpolated counter for the current power (W) and real counter (kWh) at now."""
+        if energy != self.real:
+            self.real = energy
+            self.integrated = 0.0
+        elif power > 0:
+            self.integrated += power * (now - self.last_time) / 3600000
+        self.last_time = now
+        estimate = energy + min(self.integrated, self.limit)
+        if self.value is None or estimate > self.value:
+            self.value = estimate
+        return self.value
@@ -2,16 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import socket
-import os
+import sys
+import atexit
+import signal
 import struct
 import logging
 import time
 import json
-import requests
+import queue
 from datetime import datetime
-from emeter2 import emeterPacket
-from sma_speedwire import SMA_SPEEDWIRE, smaError
-from speedwiredecoder import decode_speedwire
+from concurrent.futures import ThreadPoolExecutor, wait
+START_TIME = time.monotonic()  # for the time to the first frame, includes the imports below
+from emeter2 import emeterPacket, emeterFrame
+from sma_speedwire import SMA_SPEEDWIRE, SpeedwireTransport, smaError, discover
+from device_registry import DeviceRegistry
+from emeter_receiver import EmeterReceiver
+from poller import PollEngine, POLL_OK, POLL_ERROR, POLL_LATE, POLL_SKIPPED
+from json_source import JsonSource, OPENDTU_FIELDS
+from knx import KNXSender
+from energy_store import EnergyStateStore
+from interpolation import EnergyInterpolator
+from scheduler import PeriodicTask, DeviceScheduler
+import phases
+from metrics import Registry, MetricsServer
+from capture import CaptureWriter, KIND_EMETER, KIND_SPEEDWIRE, KIND_JSON, KIND_CYCLE, KIND_STATE, KIND_POLL
 
 # SMA inverters (IP-address, installer password, max_watt_limit)
 inverters = [
@@ -20,88 +34,179 @@ inverters = [
     ("192.168.1.64", "my-sma-password", 15000)
 ]
 
+# Concurrent polling (SMA and JSON devices): max. parallel polls and max. seconds to wait for all devices per cycle.
+# Devices which do not answer in time are counted with their last good values.
+POLL_WORKERS = 8
+POLL_DEADLINE = 4.0
+
+# Keep the speedwire login session open between polls (2 instead of 4 packets per poll)
+SMA_KEEP_SESSION = True
+# Speedwire requests per poll (see COMMAND_LIST of sma_speedwire). "spot_ac" answers with total power and power,
+# voltage and current of every phase at once. "spot_dc" (string values) and "status" (device status, grid relay)
+# are shown in the metrics, each costs one more round trip per poll.
+SMA_COMMANDS = ("energy", "spot_ac")
+# Inverters are initialised in parallel at start, the main loop waits at most this many seconds for them.
+# Slower ones are added as soon as they are ready.
+SMA_INIT_TIMEOUT = 2.0
+
+# Find more SMA inverters by speedwire discovery (multicast, in the background at start and every SMA_DISCOVERY_INTERVAL
+# seconds). Devices of SMA_DISCOVERY_CLASSES which are not in the list above are added with SMA_DISCOVERY_PASSWORD
+# and SMA_DISCOVERY_MAX_WATT. Serial and type of all devices are kept in DEVICE_REGISTRY_FILE, so a restart needs
+# no info request and uses discovered devices right away.
+SMA_DISCOVERY = True
+SMA_DISCOVERY_INTERVAL = 3600
+SMA_DISCOVERY_TIMEOUT = 2.0
+SMA_DISCOVERY_PASSWORD = "0000"
+SMA_DISCOVERY_MAX_WATT = 15000
+SMA_DISCOVERY_CLASSES = ("Solar Inverter",)  # e.g. not the battery inverter (Sunny Island)
+SMA_DISCOVERY_MAX_BACKOFF = 86400  # devices which fail to initialise (other password, no inverter) are tried less often
+
 # Hoymiles inverters: (API-URL, max_watt_limit, max_consecutive_timeouts)
 hoymiles_devices = [
 #    ("http://192.168.1.72/api/livedata/status", 2500, 3)
 ]
+HOYMILES_TIMEOUT = 2
+
+# Other JSON devices (Shelly, counters, other DTUs, ...): fields are dotted paths into the JSON answer,
+# a "*" sums up all entries of a list (e.g. one payload with many inverters).
+# Units are fixed (power_unit/energy_unit) or read from the answer (power_unit_path/energy_unit_path).
+json_devices = [
+#    {"url": "http://192.168.1.80/rpc/Switch.GetStatus?id=0", "power": "apower", "power_unit": "W",
+#     "energy": "aenergy.total", "energy_unit": "Wh", "max_watt": 800, "max_timeouts": 3},
+#    {"url": "http://192.168.1.82/api/livedata/status", "label": "DTU",
+#     "power": "inverters.*.AC.0.Power.v", "power_unit_path": "inverters.*.AC.0.Power.u",
+#     "energy": "inverters.*.INV.0.YieldTotal.v", "energy_unit_path": "inverters.*.INV.0.YieldTotal.u",
+#     "max_watt": 4000, "max_timeouts": 3},
+]
+
+# All JSON sources, Hoymiles devices are read with the OpenDTU field definition
+json_sources = [
+    JsonSource(url, max_watt=max_watt, max_timeouts=max_timeouts, label="Hoymiles", timeout=HOYMILES_TIMEOUT, **OPENDTU_FIELDS)
+    for url, max_watt, max_timeouts in hoymiles_devices
+] + [JsonSource(**device) for device in json_devices]
+
+# Phase of single-phase devices (inverter IP or JSON URL -> 1, 2 or 3), all other devices are split evenly over L1-L3
+SOURCE_PHASES = {
+#    "http://192.168.1.72/api/livedata/status": 2,
+}
 
-# SMA Energy Meters
+# SMA Energy Meters, the consume values of CONSUME_METERS are counted as supply
 SUPPLY_METERS = []
 CONSUME_METERS = [1900123456]
-consume_to_supply = {
-    'pconsume': 'psupply', 'pconsumecounter': 'psupplycounter'
-}
-meter_data = {}
+# Values of a meter older than this (seconds) are treated as stale
+METER_MAX_AGE = 10.0
+# Only these values are decoded from the Energy Meter frames (totals and phases, supply and consume)
+METER_CHANNELS = phases.METER_CHANNELS
 
-# KNX Integration (apt-get install knxd-tools)
+# KNX Integration (needs a running knxd, apt-get install knxd)
 ENABLE_KNX = True
+KNX_URL = "ip:localhost"           # knxd address, "ip:host[:port]" or "local:/run/knx"
+KNX_DEADBAND = 0.0                 # only send values which changed more than this (0 = any change)
+KNX_REFRESH = 300                  # but send every value at least every KNX_REFRESH seconds
 MAIN_METER_SN = [1900242736]
 KNX_ADDRESS_GENERATION = "11/1/1"  # Value from virtual/emulated energy meter (psupply)
 KNX_ADDRESS_FEEDIN = "11/1/2"      # Value from Master-energy meter (psupply)
 KNX_ADDRESS_SUPPLY = "11/1/3"      # Value from Master-energy meter (consume)
 
+# Serial numbers of all Energy Meters we listen to
+wanted_meters = set(SUPPLY_METERS + CONSUME_METERS + (MAIN_METER_SN if ENABLE_KNX else []))
+
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics (poll latencies, timeouts, frames, cycle time, ...)
+ENABLE_METRICS = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9109
+
+# Record all received traffic and the cycle results for replay with capture.py (None = off)
+CAPTURE_FILE = None  # e.g. "/tmp/sma_capture.bin"
+
 ENERGY_STATE_FILE = "/tmp/sma_last_energy.json"
+ENERGY_STATE_FLUSH_INTERVAL = 300  # seconds, changed values are written at most this often (and on exit)
+DEVICE_REGISTRY_FILE = "/tmp/sma_devices.json"
 
 VIRTUAL_METER_SN = 1900888888 # should start with 1900 and have 10 digits in total
+# Virtual meters to send: serial -> sources summed up in this meter (None = all sources).
+# Sources are inverter IPs, JSON device URLs and Energy Meter serials. Every device is polled only once,
+# no matter in how many virtual meters it is used.
+VIRTUAL_METERS = {
+    VIRTUAL_METER_SN: None,
+#    1900888889: ["192.168.1.62", "192.168.1.63"],                                  # SMA PV only
+#    1900888890: ["192.168.1.64", "http://192.168.1.72/api/livedata/status"],       # second building
+}
 MULTICAST_GRP = '239.12.255.254'
 MULTICAST_PORT = 9522
 
-logging.basicConfig(
-    filename='/var/log/sma_inverter_emeter.log',  # Log-Dateipfad
-    filemode='a',
-    level=logging.INFO,
-    format='[%(asctime)s] [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-
-# Buffer for last valid values per Hoymiles device
+# The virtual meter is sent every EMIT_INTERVAL seconds (a real SMA energy meter sends every second),
+# independent of the device polling (POLL_INTERVAL_DAY while there is PV power, else POLL_INTERVAL_NIGHT)
+EMIT_INTERVAL = 1.0
+POLL_INTERVAL_DAY = 5
+POLL_INTERVAL_NIGHT = 60
+# Between polls the energy counters of the inverters/JSON devices move on with their last power on every emit,
+# instead of jumping when a device reports a new counter. They never run more than ENERGY_INTERPOLATION_LIMIT kWh
+# ahead of the real counter and never go backwards.
+ENERGY_INTERPOLATION = True
+ENERGY_INTERPOLATION_LIMIT = 1.0
+# Own poll interval for single devices (inverter IP or JSON URL -> seconds, e.g. 2 for a fast changing Shelly),
+# all others are polled every POLL_INTERVAL_DAY seconds. At night no device is polled more often than POLL_INTERVAL_NIGHT.
+POLL_INTERVALS = {}
+# Devices which fail are polled with exponential backoff (interval, 2x, 4x, ... up to POLL_MAX_BACKOFF seconds).
+# These polls are probes in the background, a cycle never waits for an offline device.
+POLL_MAX_BACKOFF = 600
+
+# Buffer for last valid values per Hoymiles/JSON device
 hoymiles_state = {
-    url: {
+    source.url: {
         "last_power": 0.0,
         "last_energy": 0.0,
         "timeouts": 0
-    } for url, _, _ in hoymiles_devices
+    } for source in json_sources
 }
 
-# Buffer for last valid values per SMA Energy Meter
-energy_state = {}
+# Buffer for last valid values per SMA inverter
+sma_state = {
+    ip: {
+        "last_power": 0.0,
+    } for ip, _, _ in inverters
+}
 
-# Load last known energy values per inverter (by IP or ID)
-def load_energy_state():
-    try:
-        if os.path.exists(ENERGY_STATE_FILE):
-            with open(ENERGY_STATE_FILE, "r") as f:
-                return json.load(f)
-    except Exception as e:
-        logging.error(f"Failed to load energy state: {e}")
-    return {}
-
-# Save energy state to disk
-def save_energy_state(state):
-    try:
-        os.makedirs(os.path.dirname(ENERGY_STATE_FILE), exist_ok=True)
-        with open(ENERGY_STATE_FILE, "w") as f:
-            json.dump(state, f)
-    except Exception as e:
-        logging.error(f"Failed to save energy state: {e}")
-
-# --- Helper to merge SMA Energy Meter values ---
-def merge_to_same_keys(base, add, keys):
-    for k in keys:
-        if k in add:
-            base[k] = base.get(k, 0.0) + add.get(k, 0.0)
-
-def merge_consume_as_supply(base, add, mapping):
-    for src, dst in mapping.items():
-        if src in add:
-            base[dst] = base.get(dst, 0.0) + add[src]
+# Last known energy values per inverter (by IP, URL or serial), loaded in main()
+energy_state = EnergyStateStore(ENERGY_STATE_FILE, ENERGY_STATE_FLUSH_INTERVAL)
+
+# Serial and type of the speedwire devices, loaded in main()
+device_registry = DeviceRegistry(DEVICE_REGISTRY_FILE)
+# Inverters found by discovery or initialised after SMA_INIT_TIMEOUT, added to sma_devices by the main loop (ip, max_watt, device)
+new_devices = queue.Queue()
+# Discovered devices whose init failed, tried again with backoff (only used by the discovery thread)
+discovery_retry = DeviceScheduler(SMA_DISCOVERY_MAX_BACKOFF)
+
+# Time (time.monotonic()) of the last good value per inverter/JSON device, for the value age metric
+value_times = {}
+
+# Metrics, always collected, served if ENABLE_METRICS
+metrics = Registry()
+metric_poll_seconds = metrics.histogram("sma_emeter_poll_seconds", "Duration of one device poll", ("source",))
+metric_poll_results = metrics.counter("sma_emeter_poll_results_total", "Polls per device and result (ok, error, late)", ("source", "status"))
+metric_round_trips = metrics.counter("sma_emeter_speedwire_requests_total", "Speedwire requests sent", ("inverter",))
+metric_timeouts = metrics.counter("sma_emeter_speedwire_timeouts_total", "Speedwire requests without answer", ("inverter",))
+metric_retries = metrics.counter("sma_emeter_speedwire_retries_total", "Speedwire requests sent again after a timeout", ("inverter",))
+metric_sensor = metrics.gauge("sma_emeter_inverter_value", "Last value read from an SMA inverter (sensors of sma_speedwire)", ("inverter", "sensor"))
+metric_poll_interval = metrics.gauge("sma_emeter_poll_interval_seconds", "Current poll interval per device, including the backoff", ("source",))
+metric_first_frame = metrics.gauge("sma_emeter_first_frame_seconds", "Seconds from start to the first virtual meter frame, "
+                                   "with values from the saved state and from the first poll", ("values",))
+metric_frames_received = metrics.counter("sma_emeter_meter_frames_received_total", "Energy Meter frames received", ("serial",))
+metric_frames_dropped = metrics.counter("sma_emeter_meter_frames_dropped_total", "Frames of devices we do not listen to", ("serial",))
+metric_cycle_seconds = metrics.histogram("sma_emeter_cycle_seconds", "Duration of one poll cycle")
+metric_emit_jitter = metrics.histogram("sma_emeter_emit_jitter_seconds", "Deviation of the virtual meter send interval from EMIT_INTERVAL",
+                                       buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+metric_value_age = metrics.gauge("sma_emeter_value_age_seconds", "Age of the value of each source in the current sum", ("source",))
 
 # Setup SMA Energy Meter listener
-recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-recv_sock.bind(('', 9522))
-mreq = struct.pack("4sl", socket.inet_aton(MULTICAST_GRP), socket.INADDR_ANY)
-recv_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+def setup_receiver_socket():
+    recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    recv_sock.bind(('', 9522))
+    mreq = struct.pack("4sl", socket.inet_aton(MULTICAST_GRP), socket.INADDR_ANY)
+    recv_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return recv_sock
 
 # Redirect errors and output to log file
 class MyLogger:
@@ -111,310 +216,571 @@ class MyLogger:
     def flush(self):
         pass
 
-# Init inverter objects
-sma_devices = []
-for ip, pwd, max_watt in inverters:
+def init_sma_device(ip, pwd, transport, discovered=False):
+    """Inverter object, identity from the device registry if known, else from an info request (None on errors)."""
+    dev = SMA_SPEEDWIRE(ip, pwd, session=SMA_KEEP_SESSION, transport=transport, commands=SMA_COMMANDS)
+    info = device_registry.get(ip)
+    if info is not None:
+        dev.restore(info)
+        return dev
     try:
-        dev = SMA_SPEEDWIRE(ip, pwd)
         dev.init()
-        sma_devices.append(dev)
     except smaError as e:
         print(f"Init-error at {ip}: {e}")
-
-def normalize_power(value, unit):
-    """Convert power to watts."""
-    if unit == "W":
-        return value
-    elif unit == "kW":
-        return value * 1000
-    elif unit == "mW":
-        return value / 1000
-    else:
-        raise ValueError(f"Unkown power unit: {unit}")
-
-def normalize_energy(value, unit):
-    """Convert energy to kWh."""
-    if unit == "kWh":
-        return value
-    elif unit == "Wh":
-        return value / 1000
-    elif unit == "MWh":
-        return value * 1000
-    else:
-        raise ValueError(f"Unknown energy unit: {unit}")
-
-def float_to_dpt9_bytes(value):
-    exponent = 0
-    mantissa = int(round(value * 100))
-    sign = 0
-
-    if mantissa < 0:
-        sign = 1
-        mantissa = (~(-mantissa) + 1) & 0x7FF  # 2er-Komplement
-
-    while mantissa > 2047:
-        mantissa >>= 1
-        exponent += 1
-
-    data = ((sign << 15) | (exponent << 11) | mantissa)
-    high_byte = (data >> 8) & 0xFF
-    low_byte = data & 0xFF
-    return f"0x{high_byte:02X}", f"0x{low_byte:02X}"
-
-def knx_send(group_address, value):
-    try:
-        byte1,byte2 = float_to_dpt9_bytes(value)
-        subprocess.run(
-            ["knxtool", "groupwrite", "ip:localhost", group_address, byte1, byte2],
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-    except Exception as e:
-        logging.error(f"KNX send error ({group_address}): {e}")
+        dev.close()
+        return None
+    device_registry.remember(ip, dev, discovered)
+    return dev
+
+# Init inverter objects (configured and discovered earlier), all inverters share one speedwire socket
+def init_sma_devices(transport):
+    devices = []
+    configured = {ip for ip, _, _ in inverters}
+    found = [(ip, SMA_DISCOVERY_PASSWORD, SMA_DISCOVERY_MAX_WATT) for ip in device_registry.discovered(SMA_DISCOVERY_CLASSES)
+             if ip not in configured] if SMA_DISCOVERY else []
+    executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix="init")
+    futures = [(ip, max_watt, executor.submit(init_sma_device, ip, pwd, transport, ip not in configured))
+               for ip, pwd, max_watt in inverters + found]
+    wait([future for _, _, future in futures], timeout=SMA_INIT_TIMEOUT)
+    for ip, max_watt, future in futures:
+        if not future.done():
+            logging.warning(f"[Init] {ip} not ready within {SMA_INIT_TIMEOUT}s, adding it later")
+            future.add_done_callback(lambda future, ip=ip, max_watt=max_watt:
+                                     future.result() is not None and new_devices.put((ip, max_watt, future.result())))
+            continue
+        dev = future.result()
+        if dev is not None:
+            sma_state.setdefault(ip, {"last_power": 0.0})
+            devices.append((ip, max_watt, dev))
+    executor.shutdown(wait=False)
+    device_registry.save()
+    return devices
+
+def discover_devices():
+    # runs in the discovery thread: new devices are initialised here and handed to the main loop
+    known = {ip for ip, _, _ in inverters} | {ip for ip, _, _ in sma_devices}
+    due = set(discovery_retry.due())
+    for ip in discover(SMA_DISCOVERY_TIMEOUT):
+        info = device_registry.get(ip)
+        if ip in known or (info is not None and info.get("inv_class") not in SMA_DISCOVERY_CLASSES):
+            continue
+        if ip in discovery_retry.devices and ip not in due:
+            continue    # init failed before, not tried again yet
+        dev = init_sma_device(ip, SMA_DISCOVERY_PASSWORD, speedwire_transport, discovered=True)
+        if dev is None:
+            if ip not in discovery_retry.devices:
+                discovery_retry.add(ip, SMA_DISCOVERY_INTERVAL)
+            discovery_retry.done(ip, False)
+            logging.info(f"[Discovery] {ip} not initialised, next try in {discovery_retry.interval(ip):.0f}s")
+            continue
+        discovery_retry.devices.pop(ip, None)
+        if dev.inv_class not in SMA_DISCOVERY_CLASSES:
+            logging.info(f"[Discovery] Ignoring {ip}: {dev.inv_class} {dev.inv_type}")
+            dev.close()
+            continue
+        new_devices.put((ip, SMA_DISCOVERY_MAX_WATT, dev))
+    device_registry.save()
+
+def add_new_devices():
+    while not new_devices.empty():
+        ip, max_watt, dev = new_devices.get()
+        logging.info(f"[Init] Adding SMA inverter {ip}: {dev.inv_type}, serial {dev.serial}")
+        sma_state.setdefault(ip, {"last_power": 0.0})
+        sma_devices.append((ip, max_watt, dev))
+        poll_scheduler.add(ip, POLL_INTERVALS.get(ip, POLL_INTERVAL_DAY))
+        if capture:
+            dev.recorder = lambda host, data, writer=capture: writer.write(KIND_SPEEDWIRE, host, data)
+    device_registry.save()
+
+def init_scheduler():
+    scheduler = DeviceScheduler(POLL_MAX_BACKOFF)
+    for key in [ip for ip, _, _ in sma_devices] + [source.url for source in json_sources]:
+        scheduler.add(key, POLL_INTERVALS.get(key, POLL_INTERVAL_DAY))
+    return scheduler
+
+# Save energy state and logout from inverters on shutdown (systemd stops the service with SIGTERM)
+def shutdown():
+    energy_state.flush(force=True)
+    for ip, _, dev in sma_devices:
+        dev.close()
+    if speedwire_transport:
+        speedwire_transport.close()
+    if knx_sender:
+        knx_sender.close()
+    if capture:
+        capture.close()
+
+def poll_sma(dev):
+    dev.update()
+    return sma_values(dev)
+
+SMA_PHASE_SENSORS = [(f"power_ac_l{n}", f"voltage_ac_l{n}", f"current_ac_l{n}") for n in (1, 2, 3)]
+
+def sma_values(dev):
+    """(power, energy, ac) of an inverter, ac are (power, voltage, current) of L1-L3 or None if not read."""
+    sensors = dev.sensors
+    p = float(sensors["power_ac_total"]["value"] or 0.0)
+    e = float(sensors["energy_total"]["value"] or 0.0)
+    ac = None
+    if sensors["voltage_ac_l1"]["value"] is not None:
+        ac = tuple(tuple(float(sensors[key]["value"] or 0.0) for key in keys) for keys in SMA_PHASE_SENSORS)
+    return p, e, ac
+
+def poll_json(source):
+    return source.fetch()
 
 def setup_sender_socket():
     return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 
-def parse_and_emulate(data_dict, send_sock):
-    timestamp = int(time.time() * 1000)
-    packet = emeterPacket(int(VIRTUAL_METER_SN))
-    packet.begin(timestamp)
-
-    # Total power/energy consumption (positive) (Summierte Leistung/Energie Bezug (positiv))
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_ACTIVE_POWER, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_ACTIVE_ENERGY, 0)
-    
-    # Total power/energy feed-in (negative) (Summierte Leistung/Energie Einspeisung (negativ))
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_ACTIVE_POWER, round(data_dict['psupply'] * 10))
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY, round(data_dict['psupplycounter'] * 1000 * 3600))
-#    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY, 0)
-    
-    # Reactive power (Blindleistung)
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_REACTIVE_POWER, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_REACTIVE_ENERGY, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_REACTIVE_POWER, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_REACTIVE_ENERGY, 0)
-
-    # Apparent power (Scheinleistung)
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_APPARENT_POWER, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_APPARENT_ENERGY, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_APPARENT_POWER, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_APPARENT_ENERGY, 0)
-                
-    # cos(phi)
-    packet.addMeasurementValue(emeterPacket.SMA_POWER_FACTOR, 0)
-
-    # Phase 1
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_ACTIVE_POWER_L1, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_ACTIVE_ENERGY_L1, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_ACTIVE_POWER_L1, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY_L1, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_REACTIVE_POWER_L1, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_REACTIVE_ENERGY_L1, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_REACTIVE_POWER_L1, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_REACTIVE_ENERGY_L1, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_APPARENT_POWER_L1, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_APPARENT_ENERGY_L1, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_APPARENT_POWER_L1, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_APPARENT_ENERGY_L1, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_VOLTAGE_L1, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_CURRENT_L1, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_POWER_FACTOR_L1, 0)
-            
-    # Phase 2
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_ACTIVE_POWER_L2, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_ACTIVE_ENERGY_L2, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_ACTIVE_POWER_L2, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY_L2, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_REACTIVE_POWER_L2, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_REACTIVE_ENERGY_L2, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_REACTIVE_POWER_L2, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_REACTIVE_ENERGY_L2, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_APPARENT_POWER_L2, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_APPARENT_ENERGY_L2, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_APPARENT_POWER_L2, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_APPARENT_ENERGY_L2, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_VOLTAGE_L2, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_CURRENT_L2, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_POWER_FACTOR_L2, 0)
-                    
-    # Phase 3
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_ACTIVE_POWER_L3, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_ACTIVE_ENERGY_L3, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_ACTIVE_POWER_L3, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY_L3, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_REACTIVE_POWER_L3, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_REACTIVE_ENERGY_L3, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_REACTIVE_POWER_L3, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_REACTIVE_ENERGY_L3, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_POSITIVE_APPARENT_POWER_L3, 0)
-    packet.addCounterValue(emeterPacket.SMA_POSITIVE_APPARENT_ENERGY_L3, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_NEGATIVE_APPARENT_POWER_L3, 0)
-    packet.addCounterValue(emeterPacket.SMA_NEGATIVE_APPARENT_ENERGY_L3, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_VOLTAGE_L3, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_CURRENT_L3, 0)
-    packet.addMeasurementValue(emeterPacket.SMA_POWER_FACTOR_L3, 0)
-
-    packet.end()
-
-    send_sock.sendto(packet.getData()[:packet.getLength()], (MULTICAST_GRP, MULTICAST_PORT))
-
-# Endless looping getting values
-send_sock = setup_sender_socket()
-send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
-
-# Load previous energy state
-energy_state = load_energy_state()
-
-# Main loop
-while True:
-    try:
-        total_power = 0.0
-        total_energy = 0.0
-        log_parts = []
-
-        # 1. Collect SMA inverter data
-        for (ip, pwd, max_watt), dev in zip(inverters, sma_devices):
-            try:
-                dev.update()
-                p = float(dev.sensors["power_ac_total"]["value"] or 0.0)
-                e = float(dev.sensors["energy_total"]["value"] or 0.0)
-
-                if 0 < p <= max_watt:
-                    total_power += p
-                else:
-                    logging.warning(f"[SMA] {ip}: Ignoring power value {p} W (limit {max_watt})")
-
-                prev = energy_state.get(ip, 0.0)
-                if e >= prev:
-                    total_energy += e
-                    energy_state[ip] = e
-                else:
-                    logging.warning(f"[SMA] Energy value for {ip} decreased from {prev} to {e}, ignoring")
-
-                log_parts.append(f"SMA:{ip} P={round(p, 2)}W E={round(e, 3)}kWh")
-            except smaError as e:
-                logging.error(f"[SMA Update] Error at {ip}: {e}")
-
-        # 2. Collect Hoymiles data
-        for url, max_watt, max_timeouts in hoymiles_devices:
-            try:
-                response = requests.get(url, timeout=2)
-                data = response.json()
-                p_val = data.get("total", {}).get("Power", {}).get("v")
-                p_unit = data.get("total", {}).get("Power", {}).get("u")
-                e_val = data.get("total", {}).get("YieldTotal", {}).get("v")
-                e_unit = data.get("total", {}).get("YieldTotal", {}).get("u")
-
-                p = normalize_power(p_val, p_unit) if isinstance(p_val, (int, float)) else None
-                e = normalize_energy(e_val, e_unit) if isinstance(e_val, (int, float)) else None
-
-                if p is not None and 0 < p <= max_watt:
-                    hoymiles_state[url]["last_power"] = p
-                    hoymiles_state[url]["timeouts"] = 0
-                    total_power += p
-                else:
-                    logging.warning(f"[Hoymiles] {url}: Ignoring power value {p} W (limit {max_watt})")
-
-                prev = energy_state.get(url, 0.0)
-                if e is not None and e >= prev:
-                    total_energy += e
-                    energy_state[url] = e
-                    hoymiles_state[url]["last_energy"] = e
-                else:
-                    logging.warning(f"[Hoymiles] Energy value for {url} decreased from {prev} to {e}, using {prev}")
-                    total_energy += prev
-
-                log_parts.append(f"Hoymiles:{url.split('/')[2]} P={round(p or 0, 2)}W E={round(e or prev, 3)}kWh")
-
-            except Exception as e:
+# Sources per virtual meter (None = all) and their frames, built once and only updated with the current values
+virtual_meters = {int(sn): (set(sources) if sources is not None else None) for sn, sources in VIRTUAL_METERS.items()}
+virtual_meter_frames = {sn: emeterFrame(sn) for sn in virtual_meters}
+
+# Values sent in the virtual meter: (result key, OBIS id, factor), all feed-in (negative) values.
+# Consumption values and reactive/apparent energy counters stay 0.
+EMULATED_VALUES = [
+    ('psupply', emeterPacket.SMA_NEGATIVE_ACTIVE_POWER, 10),
+    ('psupplycounter', emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY, 1000 * 3600),
+    ('qsupply', emeterPacket.SMA_NEGATIVE_REACTIVE_POWER, 10),
+    ('ssupply', emeterPacket.SMA_NEGATIVE_APPARENT_POWER, 10),
+    ('cosphi', emeterPacket.SMA_POWER_FACTOR, 1000),
+] + [
+    (key.format(n), getattr(emeterPacket, name + f"_L{n}"), factor)
+    for n in (1, 2, 3) for key, name, factor in (
+        ('p{}supply', 'SMA_NEGATIVE_ACTIVE_POWER', 10),
+        ('p{}supplycounter', 'SMA_NEGATIVE_ACTIVE_ENERGY', 1000 * 3600),
+        ('q{}supply', 'SMA_NEGATIVE_REACTIVE_POWER', 10),
+        ('s{}supply', 'SMA_NEGATIVE_APPARENT_POWER', 10),
+        ('u{}', 'SMA_VOLTAGE', 1000),
+        ('i{}', 'SMA_CURRENT', 1000),
+        ('cosphi{}', 'SMA_POWER_FACTOR', 1000),
+    )
+]
+
+def parse_and_emulate(data_dict, send_sock, serial=VIRTUAL_METER_SN):
+    frame = virtual_meter_frames[serial]
+    frame.setTimestamp(int(time.time() * 1000))
+
+    # Power/energy feed-in (negative) (Summierte Leistung/Energie Einspeisung (negativ)), totals and per phase
+    for key, id, factor in EMULATED_VALUES:
+        frame.setValue(id, round(data_dict.get(key, 0.0) * factor))
+
+    send_sock.sendto(frame.getData(), (MULTICAST_GRP, MULTICAST_PORT))
+
+# Runtime objects, created in main()
+sma_devices = []
+speedwire_transport = None
+emeter_receiver = None
+poll_engine = None
+poll_scheduler = None
+late_polls = set()      # keys whose poll was reported late and is still running, counted once as failure
+send_sock = None
+knx_sender = None
+capture = None
+
+# Last polled values of all inverters/JSON devices as (values {key: phases array}, sums {virtual meter: phases array},
+# origin), sum None is all devices, origin "state" (saved energy counters at start) or "poll".
+# Replaced as a whole, so emit() never sees the values of one poll with the sums of another.
+# Energy Meter values are added on every emit.
+device_state = None
+first_frames = set()            # origins of which a frame was sent
+# Last values of every Energy Meter (phases array), the counters are kept while a meter is silent
+last_meter_values = {}
+last_emit = None
+# Interpolated energy counter per device {key: (EnergyInterpolator, last phases array)}, only used by emit()
+energy_interpolators = {}
+
+@metrics.collector
+def collect_metrics():
+    # counters which are counted by the devices and the receiver, value ages at the time of the scrape
+    now = time.monotonic()
+    for ip, _, dev in sma_devices:
+        metric_round_trips.set(dev.round_trips, inverter=ip)
+        metric_timeouts.set(dev.timeouts, inverter=ip)
+        metric_retries.set(dev.retries, inverter=ip)
+        for sensor, item in list(dev.sensors.items()):
+            if isinstance(item["value"], (int, float)):
+                metric_sensor.set(item["value"], inverter=ip, sensor=sensor)
+    if poll_scheduler:
+        for key in list(poll_scheduler.devices):
+            metric_poll_interval.set(poll_scheduler.interval(key), source=key)
+    for source, good in list(value_times.items()):
+        metric_value_age.set(now - good, source=source)
+    if emeter_receiver:
+        for sn, count in list(emeter_receiver.received.items()):
+            metric_frames_received.set(count, serial=sn)
+        for sn, count in list(emeter_receiver.dropped.items()):
+            metric_frames_dropped.set(count, serial=sn if sn is not None else "none")
+        for sn, (_, received) in list(emeter_receiver.latest.items()):
+            if sn in SUPPLY_METERS or sn in CONSUME_METERS:
+                metric_value_age.set(now - received, source=sn)
+
+def source_phases(key):
+    if key in SOURCE_PHASES:
+        return (SOURCE_PHASES[key],)
+    return phases.PHASES
+
+def device_phases(key, power, energy, ac=None):
+    """Phases array of a device, from the phase values of SMA inverters (ac) if there are any and SOURCE_PHASES
+    does not say otherwise."""
+    if ac and key not in SOURCE_PHASES:
+        return phases.from_phases(power, energy, ac)
+    return phases.from_power(power, energy, source_phases(key))
+
+def meter_values(snapshot):
+    """Values of the SMA Energy Meters in snapshot ({serial: (values, age)}).
+    Returns a list of (serial, phases array, stale)."""
+    meters = []
+    for sn in SUPPLY_METERS + CONSUME_METERS:
+        data, age = snapshot.get(sn, (None, None))
+        if data is None or age > METER_MAX_AGE:
+            # meter is silent (or nothing received since the start), keep its counters but do not count old power values
+            last = last_meter_values.get(sn)
+            if last is not None:
+                values = phases.counters_only(last)
+            else:
+                values = phases.new()
+                values[phases.E] = energy_state.get(str(sn), 0.0)
+            meters.append((sn, values, True))
+            continue
+        values = phases.from_meter(data, "consume" if sn in CONSUME_METERS else "supply")
+        last_meter_values[sn] = values
+        meters.append((sn, values, False))
+    return meters
+
+def interpolated_energy(values, now):
+    """Energy every device of values ({key: phases array}) produced since its real counter,
+    {key: (phases array, kWh)} (see ENERGY_INTERPOLATION)."""
+    extra = {}
+    for key, device in values.items():
+        interpolator, _ = energy_interpolators.get(key) or (EnergyInterpolator(ENERGY_INTERPOLATION_LIMIT), None)
+        energy_interpolators[key] = (interpolator, device)
+        amount = interpolator.update(device[phases.P], device[phases.E], now) - device[phases.E]
+        if amount > 0:
+            extra[key] = (device, amount)
+    for key, (interpolator, device) in energy_interpolators.items():
+        if key not in values and interpolator.value:
+            # device is no longer in the values: keep its whole last counter, so no group sum goes backwards
+            extra[key] = (device, interpolator.value)
+    return extra
+
+def group_values(serial, meters, extra=None, state=None):
+    """Sum of the devices and Energy Meters (meters list of meter_values()) of the virtual meter serial (None = all),
+    extra is the interpolated energy per device (interpolated_energy()), state the device_state to use (default: current)."""
+    sources = virtual_meters.get(serial)
+    _, sums, _ = state or device_state
+    values = sums[serial][:]
+    if extra:
+        for key, (device, amount) in extra.items():
+            if sources is None or key in sources:
+                phases.add_energy(values, device, amount)
+    for sn, meter, stale in meters:
+        if sources is None or sn in sources:
+            phases.add(values, meter)
+    return values
+
+def build_result(total_power, total_energy, values=None):
+    result = {
+        "psupply": round(total_power, 2),
+        "psupplyunit": "W",
+        "psupplycounter": round(total_energy, 3),
+        "psupplycounterunit": "kWh",
+    }
+    if values is not None:
+        result.update(phases.to_dict(values))  # reactive/apparent power and phases
+    return result
+
+def values_result(values):
+    return build_result(values[phases.P], values[phases.E], values)
+
+def set_device_values(values, origin="poll"):
+    """Makes values ({key: phases array}) the current device values and sums them up once for every virtual meter."""
+    global device_state
+    sums = {
+        sn: phases.total(v for key, v in values.items() if sources is None or key in sources)
+        for sn, sources in list(virtual_meters.items()) + [(None, None)]
+    }
+    device_state = (values, sums, origin)
+
+def saved_device_values():
+    """Values of all known devices from the saved energy state (power 0), to send frames before the first poll."""
+    keys = [ip for ip, _, _ in inverters] + [source.url for source in json_sources]
+    if SMA_DISCOVERY:
+        keys += [ip for ip in device_registry.discovered(SMA_DISCOVERY_CLASSES) if ip not in keys]
+    return {key: phases.from_power(0.0, energy_state.get(key, 0.0), source_phases(key)) for key in keys}
+
+def aggregate(poll_results, snapshot):
+    """Sum of all devices, from poll_results ({key: (status, value, duration)} of the SMA and JSON devices)
+    and snapshot ({serial: (values, age)} of the Energy Meters). Returns (values, log_parts, meters) with the sum
+    of everything as phases array, the values of every device are kept in device_values."""
+    values = {}
+    sma_ac = {}     # phase values of the SMA inverters with a valid power value
+    log_parts = []
+
+    # 1. Collect SMA inverter data
+    for ip, max_watt, _ in sma_devices:
+        status, value, duration = poll_results[ip]
+        if status != POLL_OK:
+            # not polled, late or offline: last power (0 after an error) and the last energy counter
+            if status == POLL_ERROR:
+                logging.error(f"[SMA Update] Error at {ip}: {value}")
+                sma_state[ip]["last_power"] = 0.0
+            elif status == POLL_LATE:
+                logging.warning(f"[SMA Update] No answer from {ip} within {POLL_DEADLINE}s, using last values")
+            values[ip] = (sma_state[ip]["last_power"], energy_state.get(ip, 0.0))
+            log_parts.append(f"SMA:{ip} (cached) P={round(sma_state[ip]['last_power'], 2)}W E={round(energy_state.get(ip, 0.0), 3)}kWh")
+            continue
+
+        p, e, ac = value
+        value_times[ip] = time.monotonic()
+        power = energy = 0.0
+        if 0 < p <= max_watt:
+            power = p
+            sma_state[ip]["last_power"] = p
+            sma_ac[ip] = ac
+        else:
+            logging.warning(f"[SMA] {ip}: Ignoring power value {p} W (limit {max_watt})")
+            sma_state[ip]["last_power"] = 0.0
+
+        prev = energy_state.get(ip, 0.0)
+        if e >= prev:
+            energy = e
+            energy_state[ip] = e
+        else:
+            logging.warning(f"[SMA] Energy value for {ip} decreased from {prev} to {e}, ignoring")
+        values[ip] = (power, energy)
+
+        log_parts.append(f"SMA:{ip} P={round(p, 2)}W E={round(e, 3)}kWh")
+
+    # Inverters which are not initialised (yet) keep their saved counter, like in the frames sent before the first poll
+    initialised = {ip for ip, _, _ in sma_devices}
+    for ip, _, _ in inverters:
+        if ip not in initialised and ip in energy_state:
+            values[ip] = (0.0, energy_state[ip])
+            log_parts.append(f"SMA:{ip} (not ready) P=0W E={round(energy_state[ip], 3)}kWh")
+
+    # 2. Collect Hoymiles/JSON data
+    for source in json_sources:
+        url, max_watt, max_timeouts, label = source.url, source.max_watt, source.max_timeouts, source.label
+        status, value, duration = poll_results[url]
+        if status != POLL_OK:
+            if status != POLL_SKIPPED:
                 hoymiles_state[url]["timeouts"] += 1
-                logging.error(f"[Hoymiles] Timeout/Error at {url}: {e} (#{hoymiles_state[url]['timeouts']})")
-
-                if hoymiles_state[url]["timeouts"] <= max_timeouts:
-                    total_power += hoymiles_state[url]["last_power"]
-                    total_energy += hoymiles_state[url]["last_energy"]
-                    log_parts.append(f"Hoymiles:{url.split('/')[2]} (cached) P={round(hoymiles_state[url]['last_power'], 2)}W E={round(hoymiles_state[url]['last_energy'], 3)}kWh")
-
-        # 3. Decode SMA Energy Meter packets
-        recv_sock.settimeout(0.5)
-        for _ in range(10):  # Take max 10 packets
-            try:
-                data, _ = recv_sock.recvfrom(2048)
-                decoded = decode_speedwire(data)
-                if not decoded or "serial" not in decoded:
-                    continue
-
-                sn = str(decoded["serial"])
-                if ENABLE_KNX:
-                    if sn not in map(str, SUPPLY_METERS + CONSUME_METERS + MAIN_METER_SN):
-                        continue
-                else:
-                    if sn not in map(str, SUPPLY_METERS + CONSUME_METERS):
-                        continue
-                        
-                meter_data[sn] = decoded
-                logging.debug(f"Received EM data from {sn}: {decoded}")
-            except socket.timeout:
-                break
-            except Exception as e:
-                logging.error(f"[EnergyMeter] Error while reading socket: {e}")
-                break
-
-        # 4. Summarize SMA Energy Meter values
-        em_psupply = 0.0
-        em_psupplycounter = 0.0
-
-        for sn in map(str, CONSUME_METERS):
-            if sn in meter_data:
-                merge_consume_as_supply(meter_data[sn], meter_data[sn], consume_to_supply)
-
-        for sn in map(str, SUPPLY_METERS + CONSUME_METERS):
-            data = meter_data.get(sn)
-            if not data:
+                error = value if status != POLL_LATE else f"no answer within {POLL_DEADLINE}s"
+                logging.error(f"[{label}] Timeout/Error at {url}: {error} (#{hoymiles_state[url]['timeouts']})")
+
+            # last power for max_timeouts polls, then 0, the energy counter is always kept (like the SMA inverters)
+            power = hoymiles_state[url]["last_power"] if hoymiles_state[url]["timeouts"] <= max_timeouts else 0.0
+            values[url] = (power, energy_state.get(url, 0.0))
+            log_parts.append(f"{label}:{url.split('/')[2]} (cached) P={round(power, 2)}W E={round(energy_state.get(url, 0.0), 3)}kWh")
+            continue
+
+        p, e = value
+        value_times[url] = time.monotonic()
+        power = 0.0
+        if p is not None and 0 < p <= max_watt:
+            hoymiles_state[url]["last_power"] = p
+            hoymiles_state[url]["timeouts"] = 0
+            power = p
+        else:
+            logging.warning(f"[{label}] {url}: Ignoring power value {p} W (limit {max_watt})")
+
+        prev = energy_state.get(url, 0.0)
+        if e is not None and e >= prev:
+            energy = e
+            energy_state[url] = e
+            hoymiles_state[url]["last_energy"] = e
+        else:
+            logging.warning(f"[{label}] Energy value for {url} decreased from {prev} to {e}, using {prev}")
+            energy = prev
+        values[url] = (power, energy)
+
+        log_parts.append(f"{label}:{url.split('/')[2]} P={round(p or 0, 2)}W E={round(e or prev, 3)}kWh")
+
+    set_device_values({key: device_phases(key, p, e, sma_ac.get(key)) for key, (p, e) in values.items()})
+
+    # 3. Add latest SMA Energy Meter values (received in background)
+    meters = meter_values(snapshot)
+    for sn, meter, stale in meters:
+        e = meter[phases.E]
+        if stale:
+            logging.warning(f"[EnergyMeter] No recent data from {sn}, using last counter")
+            log_parts.append(f"SMAMeter:{sn} (stale) P=0W E={round(e, 3)}kWh")
+            continue
+        log_parts.append(f"SMAMeter:{sn} P={round(meter[phases.P], 2)}W E={round(e, 3)}kWh")
+        energy_state[str(sn)] = e  # Save latest meter value
+
+    return group_values(None, meters), log_parts, meters
+
+def poll_cycle():
+    cycle_start = time.monotonic()
+
+    # Poll the SMA inverters and JSON devices which are due concurrently, failing devices are only probed in the background
+    jobs = {ip: (lambda dev=dev: poll_sma(dev)) for ip, _, dev in sma_devices}
+    jobs.update({source.url: (lambda source=source: poll_json(source)) for source in json_sources})
+    due = poll_scheduler.due(cycle_start)
+    background = {key for key in due if poll_scheduler.failing(key)}
+    poll_results = poll_engine.poll({key: jobs[key] for key in due}, POLL_DEADLINE, background)
+    poll_results.update(poll_engine.finished([key for key in jobs if key not in poll_results]))
+    for key in jobs:
+        if key not in poll_results:
+            if key in background:
+                poll_scheduler.postpone(key)
+            poll_results[key] = (POLL_SKIPPED, None, 0.0)
+            continue
+        status, value, duration = poll_results[key]
+        if key in late_polls:
+            # end of a poll which was already counted as late: only a success changes the schedule
+            if status == POLL_LATE:
                 continue
-            p = data.get("psupply", 0.0)
-            e = data.get("psupplycounter", 0.0)
-            em_psupply += p
-            em_psupplycounter += e
-            log_parts.append(f"SMAMeter:{sn} P={round(p, 2)}W E={round(e, 3)}kWh")
-            energy_state[sn] = e  # Save latest meter value
-
-        total_power += em_psupply
-        total_energy += em_psupplycounter
-
-        # Save updated energy state
-        save_energy_state(energy_state)
-
-        # Prepare and send result
-        result = {
-            "psupply": round(total_power, 2),
-            "psupplyunit": "W",
-            "psupplycounter": round(total_energy, 3),
-            "psupplycounterunit": "kWh",
-        }
-
-        if ENABLE_KNX :
-            if 'psupply' in result:
-                knx_send(KNX_ADDRESS_GENERATION, result['psupply'])
-            for sn in map(str, MAIN_METER_SN):
-                data = meter_data.get(sn)
-                if not data:
-                    continue
-                knx_send(KNX_ADDRESS_FEEDIN, data.get("psupply", 0.0))
-                knx_send(KNX_ADDRESS_SUPPLY, data.get("pconsume", 0.0))
-
+            late_polls.discard(key)
+            if status == POLL_OK:
+                poll_scheduler.done(key, True)
+            metric_poll_seconds.observe(duration, source=key)
+            continue
+        poll_scheduler.done(key, status == POLL_OK)
+        metric_poll_results.inc(source=key, status=status)
+        if status == POLL_LATE:
+            late_polls.add(key)
+        else:
+            metric_poll_seconds.observe(duration, source=key)
+    if capture:
+        capture.write(KIND_POLL, "", json.dumps({key: [status, str(value) if status == POLL_ERROR else None]
+                                                 for key, (status, value, _) in poll_results.items()}).encode())
+
+    snapshot = emeter_receiver.snapshot()
+    values, log_parts, meters = aggregate(poll_results, snapshot)
+
+    # Save updated energy state (only if changed, see ENERGY_STATE_FLUSH_INTERVAL)
+    energy_state.flush()
+
+    # Prepare result, it is sent by emit()
+    result = values_result(values)
+
+    if ENABLE_KNX :
+        knx_values = {KNX_ADDRESS_GENERATION: result['psupply']}
+        for sn in MAIN_METER_SN:
+            if sn not in snapshot:
+                continue
+            data = snapshot[sn][0]
+            knx_values[KNX_ADDRESS_FEEDIN] = data.get("psupply", 0.0)
+            knx_values[KNX_ADDRESS_SUPPLY] = data.get("pconsume", 0.0)
+        try:
+            knx_sender.send(knx_values)
+        except Exception as e:
+            logging.error(f"KNX send error ({KNX_URL}): {e}")
+
+    if capture:
+        capture.write(KIND_CYCLE, "", json.dumps(result).encode())
+
+    log_parts.append(f"SUM: P={result['psupply']}W E={result['psupplycounter']}kWh")
+    if len(virtual_meters) > 1:
+        for sn in virtual_meters:
+            group = values_result(group_values(sn, meters))
+            log_parts.append(f"SUM {sn}: P={group['psupply']}W E={group['psupplycounter']}kWh")
+    logging.info(" | ".join(log_parts))
+    metric_cycle_seconds.observe(time.monotonic() - cycle_start)
+    return result
+
+def emit():
+    # Send virtual meter with the last polled inverter values and the latest Energy Meter values
+    global last_emit
+    now = time.monotonic()
+    if last_emit is not None:
+        metric_emit_jitter.observe(abs(now - last_emit - EMIT_INTERVAL))
+    last_emit = now
+
+    state = device_state
+    if state is None:
+        return  # nothing polled yet
+    values, _, origin = state
+    meters = meter_values(emeter_receiver.snapshot())
+    extra = interpolated_energy(values, now) if ENERGY_INTERPOLATION else None
+    for sn in virtual_meters:
+        result = values_result(group_values(sn, meters, extra, state))
         try:
-            parse_and_emulate(result, send_sock)
+            parse_and_emulate(result, send_sock, sn)
         except Exception as e:
-            logging.error(f"[Emulation] Error while sending emulated data: {e}")
+            logging.error(f"[Emulation] Error while sending emulated data of {sn}: {e}")
+
+    if origin not in first_frames:
+        first_frames.add(origin)
+        metric_first_frame.set(now - START_TIME, values=origin)
+        logging.info(f"First virtual meter frame with {origin} values {now - START_TIME:.2f}s after start")
+
+def start_capture(path):
+    global capture
+    writer = capture = CaptureWriter(path)
+    writer.write(KIND_STATE, "", json.dumps(energy_state.values).encode())
+    for frame, _ in list(emeter_receiver.latest.values()):
+        writer.write(KIND_EMETER, "", frame)  # frames received before the recording started
+    emeter_receiver.recorder = lambda data: writer.write(KIND_EMETER, "", data)
+    for ip, _, dev in sma_devices:
+        dev.recorder = lambda host, data: writer.write(KIND_SPEEDWIRE, host, data)
+    for source in json_sources:
+        source.recorder = lambda url, payload: writer.write(KIND_JSON, url, payload)
+
+def main():
+    global sma_devices, speedwire_transport, emeter_receiver, poll_engine, poll_scheduler, send_sock, knx_sender, capture
+
+    logging.basicConfig(
+        filename='/var/log/sma_inverter_emeter.log',  # Log-Dateipfad
+        filemode='a',
+        level=logging.INFO,
+        format='[%(asctime)s] [%(levelname)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    atexit.register(shutdown)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Load previous energy state and the known devices, send frames with the saved counters until the first poll
+    energy_state.load()
+    device_registry.load()
+    set_device_values(saved_device_values(), "state")
+
+    known = {ip for ip, _, _ in inverters} | set(device_registry.discovered()) | {source.url for source in json_sources} | set(SUPPLY_METERS + CONSUME_METERS)
+    for sn, sources in virtual_meters.items():
+        for source in (sources or set()) - known:
+            logging.warning(f"Virtual meter {sn}: unknown source {source}")
+
+    # Receive Energy Meter frames in background, always keep the latest frame per meter
+    emeter_receiver = EmeterReceiver(setup_receiver_socket(), wanted_meters, METER_CHANNELS)
+    emeter_receiver.start()
+
+    send_sock = setup_sender_socket()
+    send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
+    emitter = PeriodicTask(EMIT_INTERVAL, emit, name="emitter")
+    emitter.start()
+
+    # All devices in parallel, at most SMA_INIT_TIMEOUT seconds
+    speedwire_transport = SpeedwireTransport()
+    sma_devices = init_sma_devices(speedwire_transport)
+    poll_engine = PollEngine(POLL_WORKERS)
+    poll_scheduler = init_scheduler()
+    if CAPTURE_FILE:
+        start_capture(CAPTURE_FILE)
+    if ENABLE_KNX:
+        knx_sender = KNXSender(KNX_URL, KNX_DEADBAND, KNX_REFRESH)
+
+    if ENABLE_METRICS:
+        try:
+            MetricsServer(metrics, METRICS_HOST, METRICS_PORT).start()
+        except OSError as e:
+            logging.error(f"Metrics server on {METRICS_HOST}:{METRICS_PORT} not started: {e}")
 
-        log_parts.append(f"SUM: P={result['psupply']}W E={result['psupplycounter']}kWh")
-        logging.info(" | ".join(log_parts))
+    if SMA_DISCOVERY:
+        PeriodicTask(SMA_DISCOVERY_INTERVAL, discover_devices, name="discovery").start()
 
-        time.sleep(5 if result['psupply'] > 0 else 60)
+    # Main loop, polling the devices whenever one is due
+    while True:
+        try:
+            add_new_devices()
+            result = poll_cycle()
+            poll_scheduler.min_interval = 0 if result['psupply'] > 0 else POLL_INTERVAL_NIGHT
+            time.sleep(max(0.1, poll_scheduler.next_poll() - time.monotonic()))
+        except Exception as e:
+            logging.critical(f"[MAIN LOOP] Uncaught exception: {e}", exc_info=True)
+            time.sleep(10)
 
-    except Exception as e:
-        logging.critical(f"[MAIN LOOP] Uncaught exception: {e}", exc_info=True)
-        time.sleep(10)
+if __name__ == "__main__":
+    main()
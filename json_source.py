@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Generic JSON sources (OpenDTU, AhoyDTU, Shelly, counters, ...).
+# Power and energy fields are given as dotted paths into the JSON payload, e.g. "total.Power.v".
+# Paths are compiled once into extractor functions, so reading a value costs one lookup per path part
+# no matter how big the payload is. A "*" part takes the rest of the path from every entry of a
+# list/dict (e.g. "inverters.*.AC.0.Power.v"), the values of all entries are summed up.
+# requests is only imported when the first source is fetched (it takes longer to import than everything else).
+
+def normalize_power(value, unit):
+    """Convert power to watts."""
+    if unit == "W":
+        return value
+    elif unit == "kW":
+        return value * 1000
+    elif unit == "mW":
+        return value / 1000
+    else:
+        raise ValueError(f"Unkown power unit: {unit}")
+
+def normalize_energy(value, unit):
+    """Convert energy to kWh."""
+    if unit == "kWh":
+        return value
+    elif unit == "Wh":
+        return value / 1000
+    elif unit == "MWh":
+        return value * 1000
+    else:
+        raise ValueError(f"Unknown energy unit: {unit}")
+
+def compile_path(path):
+    """Returns a function which takes the value at <path> out of a parsed JSON payload (None if missing)."""
+    parts = path.split(".") if path else []
+    if "*" in parts:
+        i = parts.index("*")
+        head = compile_path(".".join(parts[:i]))
+        tail = compile_path(".".join(parts[i + 1:]))
+        def extract_all(data):
+            items = head(data)
+            if isinstance(items, dict):
+                items = items.values()
+            elif not isinstance(items, list):
+                return None
+            return [tail(item) for item in items]
+        return extract_all
+
+    # dict keys stay strings (OpenDTU uses "0" as key), numeric parts can also index lists
+    keys = [(part, int(part) if part.isdigit() else None) for part in parts]
+    def extract(data):
+        for key, index in keys:
+            if isinstance(data, dict):
+                data = data.get(key)
+            elif isinstance(data, list) and index is not None and index < len(data):
+                data = data[index]
+            else:
+                return None
+        return data
+    return extract
+
+def _compile_unit(unit, unit_path):
+    if unit_path:
+        return compile_path(unit_path)
+    return lambda data: unit
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _normalized(values, units, normalize):
+    # single value or list of values ("*" paths), units may be one unit or a list of units
+    if isinstance(values, list):
+        if not isinstance(units, list):
+            units = [units] * len(values)
+        numbers = [normalize(v, u) for v, u in zip(values, units) if _number(v)]
+        return sum(numbers) if numbers else None
+    return normalize(values, units) if _number(values) else None
+
+# Field definition of OpenDTU livedata/status
+OPENDTU_FIELDS = {
+    "power": "total.Power.v",
+    "power_unit_path": "total.Power.u",
+    "energy": "total.YieldTotal.v",
+    "energy_unit_path": "total.YieldTotal.u",
+}
+
+class JsonSource:
+    """JSON device polled by HTTP GET, returns (power in W, energy in kWh).
+    Units are either fixed (power_unit/energy_unit) or read from the payload (power_unit_path/energy_unit_path)."""
+
+    def __init__(self, url, power, energy=None, power_unit="W", energy_unit="kWh",
+                 power_unit_path=None, energy_unit_path=None,
+                 max_watt=30000, max_timeouts=3, label="JSON", timeout=2):
+        self.url = url
+        self.max_watt = max_watt
+        self.max_timeouts = max_timeouts
+        self.label = label
+        self.timeout = timeout
+        self._power = compile_path(power)
+        self._power_unit = _compile_unit(power_unit, power_unit_path)
+        self._energy = compile_path(energy) if energy else (lambda data: None)
+        self._energy_unit = _compile_unit(energy_unit, energy_unit_path)
+        self.session = None
+        self.recorder = None    # function(url, payload), called with every answer (see capture.py)
+
+    def parse(self, data):
+        p = _normalized(self._power(data), self._power_unit(data), normalize_power)
+        e = _normalized(self._energy(data), self._energy_unit(data), normalize_energy)
+        return p, e
+
+    def fetch(self):
+        # one session per source keeps the connection open, a source is never fetched by two threads at once
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+        response = self.session.get(self.url, timeout=self.timeout)
+        if self.recorder:
+            self.recorder(self.url, response.content)
+        return self.parse(response.json())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Sends values to the KNX bus through one permanent connection to knxd.
+# Speaks the knxd client protocol (same as knxtool), but without starting a process per value.
+
+import time
+import select
+import socket
+import struct
+import logging
+
+EIB_OPEN_GROUPCON = 0x0026
+EIB_GROUP_PACKET = 0x0027
+APCI_GROUP_WRITE = 0x80
+KNXD_PORT = 6720
+
+def float_to_dpt9_bytes(value):
+    """Encode value as KNX DPT 9 (2-byte float), returns 2 bytes."""
+    exponent = 0
+    mantissa = int(round(value * 100))
+
+    while mantissa > 2047 or mantissa < -2048:
+        mantissa >>= 1
+        exponent += 1
+    if exponent > 15:  # out of range, send max. value
+        exponent = 15
+        mantissa = 2047 if value > 0 else -2048
+
+    sign = 1 if mantissa < 0 else 0
+    data = ((sign << 15) | (exponent << 11) | (mantissa & 0x7FF))  # 2er-Komplement for negative mantissa
+    return struct.pack(">H", data)
+
+def group_address(address):
+    """'11/1/3' -> 16 bit group address"""
+    main, middle, sub = (int(part) for part in address.split("/"))
+    return (main << 11) | (middle << 8) | sub
+
+class KNXSender:
+    """Writes group values through a permanent connection to knxd.
+    url like knxtool: "ip:host[:port]" or "local:/run/knx".
+    Values are only sent if they changed by more than <deadband> (0 = any change)
+    or were not sent for <refresh> seconds."""
+
+    def __init__(self, url="ip:localhost", deadband=0.0, refresh=300, timeout=2.0, logger=None):
+        self.url = url
+        self.deadband = deadband
+        self.refresh = refresh
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.sock = None
+        self.last = {}  # group address -> (value, encoded value, time.monotonic() of sending)
+
+    def _connect(self):
+        kind, _, target = self.url.partition(":")
+        if kind == "local":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = target
+        else:
+            host, _, port = target.partition(":")
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (host or "localhost", int(port or KNXD_PORT))
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(address)
+            # open write-only group socket
+            sock.sendall(struct.pack(">HHBBB", 5, EIB_OPEN_GROUPCON, 0, 0, 0xFF))
+            answer = self._recv_exact(sock, 4)
+            size, msg_type = struct.unpack(">HH", answer)
+            self._recv_exact(sock, size - 2)
+            if msg_type != EIB_OPEN_GROUPCON:
+                raise ConnectionError(f"knxd refused group connection (answer {msg_type:#06x})")
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+
+    @staticmethod
+    def _recv_exact(sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("knxd closed the connection")
+            data += chunk
+        return data
+
+    def _check_connection(self):
+        """Raises ConnectionError if knxd closed the connection. A send on the half-closed socket
+        would still succeed, but the values never reach the bus."""
+        while select.select([self.sock], [], [], 0)[0]:
+            if not self.sock.recv(4096):   # knxd sends nothing on a write-only group connection
+                raise ConnectionError("knxd closed the connection")
+
+    def _changed(self, address, value, encoded, now):
+        last = self.last.get(address)
+        if last is None or now - last[2] >= self.refresh:
+            return True
+        if self.deadband > 0:
+            return abs(value - last[0]) > self.deadband
+        return encoded != last[1]
+
+    def send(self, values):
+        """Write {group address ("11/1/1"): value} as DPT 9 in one batch. Returns number of values sent."""
+        now = time.monotonic()
+        batch = []
+        for address, value in values.items():
+            encoded = float_to_dpt9_bytes(value)
+            if self._changed(address, value, encoded, now):
+                batch.append((address, value, encoded))
+        if not batch:
+            return 0
+
+        msg = b"".join(
+            struct.pack(">HHHBB", 8, EIB_GROUP_PACKET, group_address(address), 0x00, APCI_GROUP_WRITE) + encoded
+            for address, value, encoded in batch
+        )
+        for attempt in (1, 2):
+            try:
+                if self.sock is None:
+                    self._connect()
+                else:
+                    self._check_connection()
+                self.sock.sendall(msg)
+                self._check_connection()
+                break
+            except OSError as e:
+                self.close()
+                if attempt == 2:
+                    raise
+                self.logger.debug(f"KNX connection lost ({e}), reconnecting")
+
+        # only values which were written to an open connection count as sent
+        for address, value, encoded in batch:
+            self.last[address] = (value, encoded, now)
+        return len(batch)
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Three-phase values of a device as one flat array of doubles: a block for the totals and one per phase,
+# each block holds the fields below. Arrays of many devices are summed up element by element, voltages
+# are kept as sum and number of readings, so partial sums can be added again (e.g. all inverters of a group
+# once per poll, the Energy Meters on every emit). finish()/to_dict() turn a sum into averaged voltages,
+# currents and power factors.
+
+from array import array
+
+P, E, Q, S, U, UN = range(6)    # power W, energy kWh, reactive power var, apparent power VA, voltage sum V, number of voltages
+FIELDS = 6
+TOTAL, L1, L2, L3 = 0, 1, 2, 3
+PHASES = (L1, L2, L3)
+SIZE = 4 * FIELDS
+
+_ZERO = array('d', [0.0]) * SIZE
+_ENERGY = tuple(block * FIELDS + E for block in (TOTAL,) + PHASES)
+
+def new():
+    return _ZERO[:]
+
+def from_power(power, energy, phases=PHASES):
+    """Device which only reports total power/energy, split evenly over the phases it is connected to.
+    Apparent power is taken as the active power (power factor 1)."""
+    values = _ZERO[:]
+    values[P] = power
+    values[E] = energy
+    values[S] = abs(power)
+    share = 1.0 / len(phases)
+    for phase in phases:
+        base = phase * FIELDS
+        values[base + P] = power * share
+        values[base + E] = energy * share
+        values[base + S] = abs(power) * share
+    return values
+
+def from_phases(power, energy, ac):
+    """Device which reports (power W, voltage V, current A) of every phase L1-L3 (SMA inverters).
+    Apparent power is voltage * current, the energy is split evenly over the phases with a voltage."""
+    connected = [phase for phase, (p, u, i) in zip(PHASES, ac) if u]
+    if not connected:
+        return from_power(power, energy)
+    values = _ZERO[:]
+    values[P] = power
+    values[E] = energy
+    share = 1.0 / len(connected)
+    for phase, (p, u, i) in zip(PHASES, ac):
+        base = phase * FIELDS
+        s = u * i or abs(p)
+        values[base + P] = p
+        values[base + S] = s
+        values[S] += s
+        if u:
+            values[base + E] = energy * share
+            values[base + U] = u
+            values[base + UN] = 1.0
+    return values
+
+def _meter_keys(direction):
+    keys = []
+    for block, n in ((TOTAL, ""), (L1, "1"), (L2, "2"), (L3, "3")):
+        keys.append((block * FIELDS, f"p{n}{direction}", f"p{n}{direction}counter", f"q{n}{direction}",
+                     f"s{n}{direction}", f"u{n}" if n else None))
+    return keys
+
+_METER_KEYS = {direction: _meter_keys(direction) for direction in ("supply", "consume")}
+
+# Channels which have to be decoded from an Energy Meter frame for from_meter()
+METER_CHANNELS = {key for keys in _METER_KEYS.values() for entry in keys for key in entry[1:] if key}
+
+def from_meter(data, direction="supply"):
+    """Values of a decoded Energy Meter frame (decode_speedwire), direction "supply" or "consume"."""
+    values = _ZERO[:]
+    for base, p, e, q, s, u in _METER_KEYS[direction]:
+        values[base + P] = data.get(p, 0.0)
+        values[base + E] = data.get(e, 0.0)
+        values[base + Q] = data.get(q, 0.0)
+        values[base + S] = data.get(s, 0.0) or abs(values[base + P])  # meters without apparent power: power factor 1
+        if u:
+            voltage = data.get(u, 0.0)
+            if voltage > 0:
+                values[base + U] = voltage
+                values[base + UN] = 1.0
+    return values
+
+def counters_only(values):
+    """Copy of values with only the energy counters, for devices which are silent."""
+    result = _ZERO[:]
+    for i in _ENERGY:
+        result[i] = values[i]
+    return result
+
+def add(target, values):
+    for i in range(SIZE):
+        target[i] += values[i]
+    return target
+
+def add_energy(target, device, amount):
+    """Adds amount kWh to the energy counters of target, split over the phases like the counters of device."""
+    target[E] += amount
+    for phase in PHASES:
+        i = phase * FIELDS + E
+        target[i] += amount * (device[i] / device[E] if device[E] else 1.0 / len(PHASES))
+    return target
+
+def total(items):
+    result = _ZERO[:]
+    for values in items:
+        for i in range(SIZE):
+            result[i] += values[i]
+    return result
+
+def to_dict(values):
+    """Reactive/apparent power, power factor and the phase values of a sum, named like decode_speedwire.
+    Totals of active power/energy are left out (see build_result() of inverter_emeter)."""
+    result = {
+        "qsupply": round(values[Q], 2),
+        "ssupply": round(values[S], 2),
+        "cosphi": round(values[P] / values[S], 3) if values[S] > 0 else 0.0,
+    }
+    for phase in PHASES:
+        base = phase * FIELDS
+        p, s = values[base + P], values[base + S]
+        u = values[base + U] / values[base + UN] if values[base + UN] else 0.0
+        result[f"p{phase}supply"] = round(p, 2)
+        result[f"p{phase}supplycounter"] = round(values[base + E], 3)
+        result[f"q{phase}supply"] = round(values[base + Q], 2)
+        result[f"s{phase}supply"] = round(s, 2)
+        result[f"u{phase}"] = round(u, 3)
+        result[f"i{phase}"] = round(s / u, 3) if u > 0 else 0.0
+        result[f"cosphi{phase}"] = round(p / s, 3) if s > 0 else 0.0
+    return result
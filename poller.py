@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Runs device polls concurrently on a thread pool.
+# Every call of poll() waits at most <deadline> seconds, so one cycle costs as much as
+# the slowest device (capped by the deadline) instead of the sum of all devices.
+# A poll which is not finished in time stays pending, no second poll of the same device
+# is started. Its result is handed out by a later poll() call once it is done.
+# Background jobs (probes of devices which are known to be offline) are started the same way,
+# but never waited for.
+
+POLL_OK = "ok"
+POLL_ERROR = "error"
+POLL_LATE = "late"
+POLL_SKIPPED = "skipped"    # not polled in this cycle (not due or probe still running), set by the caller
+
+def _timed(job):
+    start = time.monotonic()
+    try:
+        return POLL_OK, job(), time.monotonic() - start
+    except Exception as e:
+        return POLL_ERROR, e, time.monotonic() - start
+
+class PollEngine:
+    def __init__(self, max_workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="poll")
+        self.pending = {}  # key -> (future, start time)
+
+    def poll(self, jobs, deadline, background=()):
+        """Run all jobs {key: callable} concurrently, wait max. <deadline> seconds for all but the keys in background.
+        Returns {key: (status, value, duration)} with status POLL_OK, POLL_ERROR (value is the exception)
+        or POLL_LATE (value is None, poll still running). Background jobs which are still running are left out."""
+        now = time.monotonic()
+        for key, job in jobs.items():
+            if key not in self.pending:
+                self.pending[key] = (self.executor.submit(_timed, job), now)
+
+        futures = [self.pending[key][0] for key in jobs if key not in background]
+        wait(futures, timeout=max(0.0, now + deadline - time.monotonic()))
+
+        results = {}
+        for key in jobs:
+            future, started = self.pending[key]
+            if not future.done():
+                if key not in background:
+                    results[key] = (POLL_LATE, None, time.monotonic() - started)
+                continue
+            del self.pending[key]
+            results[key] = future.result()
+        return results
+
+    def finished(self, keys):
+        """Results of earlier polls of keys which are done by now (e.g. late polls or probes), without starting new ones."""
+        results = {}
+        for key in keys:
+            if key in self.pending and self.pending[key][0].done():
+                results[key] = self.pending.pop(key)[0].result()
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
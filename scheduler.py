@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+
+class PeriodicTask(threading.Thread):
+    """Calls func() every <interval> seconds in its own thread.
+    Runs are planned on a fixed time.monotonic() grid, so the cadence does not drift with
+    the runtime of func(). If a run takes longer than the interval, missed runs are skipped."""
+
+    def __init__(self, interval, func, name="periodic", logger=None):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.func = func
+        self.logger = logger or logging.getLogger(__name__)
+        self.stopped = threading.Event()
+
+    def run(self):
+        next_run = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                self.func()
+            except Exception as e:
+                self.logger.error(f"[{self.name}] {e}", exc_info=True)
+            next_run += self.interval
+            now = time.monotonic()
+            if next_run < now:
+                next_run += ((now - next_run) // self.interval + 1) * self.interval
+            self.stopped.wait(next_run - now)
+
+    def stop(self):
+        self.stopped.set()
+
+class DeviceScheduler:
+    """Poll times of many devices, every device has its own interval.
+    A device which fails is polled again after interval * 2^(failures - 1), at most max_backoff seconds later.
+    Its next poll is a probe: the caller should not wait for it (see failing()). A good poll resets the interval.
+    min_interval stretches all intervals (e.g. at night)."""
+
+    def __init__(self, max_backoff=600.0):
+        self.max_backoff = max_backoff
+        self.min_interval = 0.0
+        self.devices = {}   # key -> [interval, next poll time, consecutive failures]
+
+    def add(self, key, interval):
+        self.devices[key] = [interval, time.monotonic(), 0]
+
+    def interval(self, key):
+        """Current interval of key, including the backoff."""
+        interval, _, failures = self.devices[key]
+        interval = max(interval, self.min_interval)
+        if failures:
+            # the exponent is capped, a float interval overflows after about 1000 failures
+            interval = min(interval * 2 ** min(failures - 1, 64), max(self.max_backoff, interval))
+        return interval
+
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        return [key for key, (_, next_poll, _) in self.devices.items() if next_poll <= now]
+
+    def next_poll(self):
+        """Time of the next poll of any device (time.monotonic())."""
+        return min((next_poll for _, next_poll, _ in self.devices.values()), default=time.monotonic())
+
+    def failing(self, key):
+        return self.devices[key][2] > 0
+
+    def failures(self, key):
+        return self.devices[key][2]
+
+    def postpone(self, key, now=None):
+        """Poll of key is still running, check again after its current interval."""
+        now = time.monotonic() if now is None else now
+        self.devices[key][1] = now + self.interval(key)
+
+    def done(self, key, ok, now=None):
+        """Plans the next poll of key after a poll which succeeded (ok) or failed."""
+        now = time.monotonic() if now is None else now
+        device = self.devices[key]
+        device[2] = 0 if ok else device[2] + 1
+        device[1] = now + self.interval(key)
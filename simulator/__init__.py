@@ -0,0 +1,8 @@
+# Local stand-ins for SMA inverters (speedwire), SMA Energy Meters (multicast), OpenDTU (HTTP) and knxd,
+# for load tests and benchmarks without a real plant. See "python3 -m simulator --help".
+
+from simulator.faults import Faults, NO_FAULTS
+from simulator.inverter import FakeInverter, InverterFarm, inverter_reply
+from simulator.meter import FakeMeter, MeterFarm
+from simulator.dtu import FakeDTU
+from simulator.knxd import FakeKnxd, check_sender
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Starts a simulated plant on loopback and prints the matching configuration for inverter_emeter.py.
+# Inverters listen on 127.0.x.y port 9522, so the printed "inverters" list can be used unchanged.
+# Example: python3 -m simulator --inverters 200 --dtus 20 --latency 0.05 --jitter 0.05 --loss 0.01 --offline 300:30
+
+import time
+import random
+import argparse
+from simulator import Faults, FakeInverter, InverterFarm, FakeMeter, MeterFarm, FakeDTU, FakeKnxd, check_sender
+
+def loopback_address(n):
+    return f"127.0.{n // 250 + 1}.{n % 250 + 1}"
+
+def parse_offline(value):
+    period, duration = value.split(":")
+    return float(period), float(duration)
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m simulator", description="Simulated SMA/OpenDTU plant on loopback")
+    parser.add_argument("--inverters", type=int, default=3, help="number of SMA inverters")
+    parser.add_argument("--meters", type=int, default=1, help="number of SMA Energy Meters")
+    parser.add_argument("--dtus", type=int, default=0, help="number of OpenDTUs")
+    parser.add_argument("--knxd", action="store_true", help="start a simulated knxd which records the KNX group writes")
+    parser.add_argument("--check-knx", action="store_true", help="only check the KNX sender against a simulated knxd and exit")
+    parser.add_argument("--port", type=int, default=9522, help="speedwire port of the inverters (0 = random)")
+    parser.add_argument("--meter-target", default="239.12.255.254:9522", help="destination of the meter frames")
+    parser.add_argument("--latency", type=float, default=0.0, help="answer delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay in seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of a lost packet/request (0..1)")
+    parser.add_argument("--offline", type=parse_offline, help="PERIOD:DURATION, devices drop out for DURATION seconds every PERIOD seconds")
+    parser.add_argument("--seed", type=int, help="random seed for reproducible faults")
+    args = parser.parse_args()
+    if args.check_knx:
+        check_sender()
+        return
+
+    rand = random.Random(args.seed)
+    def faults():
+        # spread the offline periods over the devices
+        phase = rand.uniform(0, args.offline[0]) if args.offline else 0.0
+        return Faults(args.latency, args.jitter, args.loss, args.offline, phase, rand.random())
+
+    inverters = [
+        FakeInverter(serial=2001000000 + n, power=1000 + rand.randrange(4000), energy=rand.randrange(10**7, 10**8),
+                     host=loopback_address(n), port=args.port, faults=faults())
+        for n in range(args.inverters)
+    ]
+    meters = [FakeMeter(serial=1900100000 + n, consume=rand.uniform(100, 3000), faults=faults()) for n in range(args.meters)]
+    knxd = FakeKnxd(faults=faults()).start() if args.knxd else None
+    dtus = [FakeDTU(power=rand.uniform(50, 1600), energy=rand.uniform(100, 5000), faults=faults()).start() for n in range(args.dtus)]
+
+    farm = InverterFarm(inverters)
+    farm.start()
+    host, port = args.meter_target.rsplit(":", 1)
+    meter_farm = MeterFarm(meters, (host, int(port)))
+    meter_farm.start()
+
+    print("inverters = [")
+    for inverter in inverters:
+        print(f'    ("{inverter.host}", "0000", 15000),' + (f"  # port {inverter.port}" if args.port != 9522 else ""))
+    print("]")
+    print("hoymiles_devices = [")
+    for dtu in dtus:
+        print(f'    ("{dtu.url}", 2500, 3),')
+    print("]")
+    print(f"CONSUME_METERS = {[meter.serial for meter in meters]}")
+    if knxd:
+        print(f'KNX_URL = "{knxd.url}"')
+
+    try:
+        while True:
+            time.sleep(10)
+            requests = sum(inverter.requests for inverter in inverters)
+            print(f"speedwire requests: {requests}, meter frames: {meter_farm.sent}, DTU requests: {sum(dtu.requests for dtu in dtus)}"
+                  + (f", KNX writes: {len(knxd.writes)} {knxd.values()}" if knxd else ""))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        farm.stop()
+        meter_farm.stop()
+        for dtu in dtus:
+            dtu.stop()
+        if knxd:
+            knxd.stop()
+
+if __name__ == "__main__":
+    main()
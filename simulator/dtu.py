@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from simulator.faults import NO_FAULTS
+
+class _DTUHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        dtu = self.server.dtu
+        dtu.requests += 1
+        if dtu.faults.is_offline() or dtu.faults.lost():
+            self.close_connection = True    # no answer, the client runs into its timeout or a connection error
+            return
+        delay = dtu.faults.delay()
+        if delay > 0:
+            time.sleep(delay)
+        body = json.dumps(dtu.payload()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeDTU:
+    """Simulated OpenDTU (api/livedata/status) with one or more Hoymiles inverters, power in W, energy in kWh."""
+
+    def __init__(self, power=412.5, energy=1234.5, inverters=1, host="127.0.0.1", port=0, faults=NO_FAULTS):
+        self.power = power
+        self.energy = energy
+        self.inverters = inverters
+        self.faults = faults
+        self.requests = 0
+        self.last_update = time.monotonic()
+        self.server = ThreadingHTTPServer((host, port), _DTUHandler)
+        self.server.daemon_threads = True
+        self.server.dtu = self
+        self.url = f"http://{host}:{self.server.server_address[1]}/api/livedata/status"
+
+    def payload(self):
+        now = time.monotonic()
+        self.energy += self.power * (now - self.last_update) / 3600 / 1000
+        self.last_update = now
+        power = self.power / self.inverters
+        energy = self.energy / self.inverters
+        return {
+            "inverters": [{
+                "serial": f"11418291{n:04d}", "reachable": True,
+                "AC": {"0": {"Power": {"v": power, "u": "W", "d": 1}}},
+                "INV": {"0": {"YieldTotal": {"v": energy, "u": "kWh", "d": 3}}},
+            } for n in range(self.inverters)],
+            "total": {
+                "Power": {"v": self.power, "u": "W", "d": 1},
+                "YieldTotal": {"v": self.energy, "u": "kWh", "d": 3},
+            },
+        }
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="sim-dtu", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import random
+
+class Faults:
+    """Failure behaviour of a simulated device.
+    latency/jitter: seconds added to every answer (latency + random 0..jitter)
+    loss: probability (0..1) that a request or frame gets lost
+    offline: (period, duration), the device is gone for <duration> seconds every <period> seconds,
+    shifted by <phase> seconds so not all devices drop out at the same time."""
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, offline=None, phase=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.offline = offline
+        self.phase = phase
+        self.random = random.Random(seed)
+        self.start = time.monotonic()
+
+    def is_offline(self, now=None):
+        if not self.offline:
+            return False
+        period, duration = self.offline
+        now = time.monotonic() if now is None else now
+        return (now - self.start + self.phase) % period >= period - duration
+
+    def lost(self):
+        return self.loss > 0 and self.random.random() < self.loss
+
+    def delay(self):
+        if self.jitter > 0:
+            return self.latency + self.random.random() * self.jitter
+        return self.latency
+
+NO_FAULTS = Faults()
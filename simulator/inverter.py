@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import socket
+import selectors
+import threading
+from struct import pack_into, unpack_from
+from sma_speedwire import COMMAND_LIST, SMA_ESIGNATURE, RECORD_TYPE_SIGNED, RECORD_TYPE_STATUS, DISCOVERY_REQUEST
+from simulator.faults import NO_FAULTS
+
+ERROR_NOT_LOGGED_IN = 0x0017
+
+def _records(reply, records, size):
+    """Appends data records [(code, data type, value)] of size bytes to reply, sets record numbers and lengths."""
+    for code, kind, value in records:
+        record = bytearray(size)
+        pack_into("<BHBI", record, 0, 1, code, kind, int(time.time()))
+        if size == 16:
+            pack_into("<Q", record, 8, value)
+        elif kind == RECORD_TYPE_STATUS:
+            pack_into("<II", record, 8, 0x01000000 | value, 0x00FFFFFE)   # selected attribute, end of attributes
+        else:
+            pack_into("<i" if kind == RECORD_TYPE_SIGNED else "<I", record, 8, value)
+        reply += record
+    pack_into("<II", reply, 46, 1, len(records))                         # numbers of first and last record
+    reply[18] = (len(reply) - 18) // 4
+    reply += bytes(4)                                                    # end of packet
+    pack_into(">H", reply, 12, len(reply) - 20)
+
+def inverter_records(power, energy, today, voltage=230.0, phases=3, status=307):
+    """Records of the data commands of COMMAND_LIST: command -> (record size, [(code, data type, value)])."""
+    ac = []
+    for n in range(3):
+        p = power / phases if n < phases else None     # phases the inverter is not connected to have no values
+        ac += [(0x4640 + n, RECORD_TYPE_SIGNED, round(p) if p is not None else -0x80000000),
+               (0x4648 + n, 0, round(voltage * 100) if p is not None else 0xFFFFFFFF),
+               (0x4653 + n, 0, round(p / voltage * 1000) if p is not None else 0xFFFFFFFF)]
+    dc = power * 1.03
+    return {
+        COMMAND_LIST["energy"][0]: (16, [(0x2601, 0, energy), (0x2622, 0, today)]),
+        COMMAND_LIST["spot_ac"][0]: (28, sorted([(0x263F, RECORD_TYPE_SIGNED, power), (0x4657, 0, 5000)] + ac)),
+        COMMAND_LIST["spot_dc"][0]: (28, [(0x251E, RECORD_TYPE_SIGNED, round(dc)), (0x451F, RECORD_TYPE_SIGNED, 38000),
+                                          (0x4521, RECORD_TYPE_SIGNED, round(dc / 380 * 1000))]),
+        COMMAND_LIST["status"][0]: (40, [(0x2148, RECORD_TYPE_STATUS, status), (0x4164, RECORD_TYPE_STATUS, 51)]),
+    }
+
+def discovery_reply(host):
+    """Answer of an SMA inverter to the speedwire discovery request (tag 0x0030 carries its IP address)."""
+    return (b"SMA\0" + bytes.fromhex("000402a000000001000200000001000400100001000300040020000000010004" + "0030")
+            + socket.inet_aton(host) + bytes.fromhex("00020070ef0c00000000"))
+
+def inverter_reply(request, serial=2001234567, susyid=0x7D, power=2345, energy=12345678, today=5000,
+                   inv_class=8001, inv_type=9302, error=0, voltage=230.0, phases=3):
+    """Answer of an SMA inverter to a speedwire request (None for logout), in the format SMA_SPEEDWIRE._parse reads.
+    power in W, energy and today in Wh. Data requests are answered with all records within first/last,
+    the power is split evenly over the first phases, DC power is 3% above it."""
+    command, first, last = unpack_from("<III", request, 42)
+    if command == COMMAND_LIST["logout"][0]:
+        return None
+    reply = bytearray(54)
+    reply[0:4] = b"SMA\0"
+    reply[14:18] = bytes.fromhex(SMA_ESIGNATURE)
+    pack_into("<HI", reply, 28, susyid, serial)
+    pack_into("<I", reply, 36, error)
+    reply[40:42] = request[40:42]                   # packet id
+    pack_into("<I", reply, 42, command + 1)
+    if command == COMMAND_LIST["info"][0] and not error:
+        reply += bytes(166)
+        pack_into("<H", reply, 55, 0x821E)
+        pack_into("<I", reply, 102, inv_class)
+        pack_into("<II", reply, 142, 0x01000000 | inv_type, 0x00FFFFFE)   # type, end of attributes
+        return bytes(reply)
+    size, records = inverter_records(power, energy, today, voltage, phases).get(command, (28, []))
+    if error:
+        records = []
+    _records(reply, [record for record in records if first >> 8 <= record[0] <= last >> 8], size)
+    return bytes(reply)
+
+class FakeInverter:
+    """Simulated SMA inverter on a local UDP socket.
+    Data requests are only answered after a login (else error 0x17, like a real inverter after a restart),
+    sessions are dropped while the device is offline. The energy counter grows with the current power."""
+
+    def __init__(self, serial=2001234567, power=2345, energy=12345678, host="127.0.0.1", port=0,
+                 faults=NO_FAULTS, require_login=True, phases=3):
+        self.serial = serial
+        self.power = power
+        self.phases = phases
+        self.energy = float(energy)
+        self.faults = faults
+        self.require_login = require_login
+        self.sessions = set()           # addresses which are logged in
+        self.requests = 0               # number of requests received (also lost ones)
+        self.last_update = time.monotonic()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.host, self.port = self.sock.getsockname()
+
+    def handle(self, request, address):
+        """Returns the answer to request (None = no answer)."""
+        self.requests += 1
+        now = time.monotonic()
+        self.energy += self.power * (now - self.last_update) / 3600
+        self.last_update = now
+        if self.faults.is_offline(now):
+            self.sessions.clear()
+            return None
+        if self.faults.lost():
+            return None
+        if request == DISCOVERY_REQUEST:
+            return discovery_reply(self.host)
+        if len(request) < 58:
+            return None
+
+        command = unpack_from("<I", request, 42)[0]
+        error = 0
+        if command == COMMAND_LIST["login"][0]:
+            self.sessions.add(address)
+        elif command == COMMAND_LIST["logout"][0]:
+            self.sessions.discard(address)
+        elif self.require_login and address not in self.sessions:
+            error = ERROR_NOT_LOGGED_IN
+        return inverter_reply(request, serial=self.serial, power=int(self.power), energy=int(self.energy), error=error,
+                              phases=self.phases)
+
+    def close(self):
+        self.sock.close()
+
+class InverterFarm(threading.Thread):
+    """Serves any number of FakeInverters from one thread, delayed answers are kept in a heap."""
+
+    def __init__(self, inverters):
+        super().__init__(name="sim-inverters", daemon=True)
+        self.inverters = list(inverters)
+        self.running = True
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        for inverter in self.inverters:
+            inverter.sock.setblocking(False)
+            selector.register(inverter.sock, selectors.EVENT_READ, inverter)
+        pending = []    # (due time, sequence, inverter, answer, address)
+        sequence = 0
+        while self.running:
+            timeout = 0.5
+            if pending:
+                timeout = min(timeout, max(0.0, pending[0][0] - time.monotonic()))
+            for key, _ in selector.select(timeout):
+                inverter = key.data
+                try:
+                    request, address = inverter.sock.recvfrom(1024)
+                except OSError:
+                    continue
+                answer = inverter.handle(request, address)
+                if answer is None:
+                    continue
+                delay = inverter.faults.delay()
+                if delay > 0:
+                    sequence += 1
+                    heapq.heappush(pending, (time.monotonic() + delay, sequence, inverter, answer, address))
+                else:
+                    inverter.sock.sendto(answer, address)
+            now = time.monotonic()
+            while pending and pending[0][0] <= now:
+                _, _, inverter, answer, address = heapq.heappop(pending)
+                inverter.sock.sendto(answer, address)
+        selector.close()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import struct
+import threading
+import socketserver
+from knx import EIB_OPEN_GROUPCON, EIB_GROUP_PACKET, APCI_GROUP_WRITE
+from simulator.faults import NO_FAULTS
+
+def dpt9_bytes_to_float(data):
+    """Decode 2 bytes KNX DPT 9 (2-byte float), the counterpart of knx.float_to_dpt9_bytes()."""
+    raw = struct.unpack(">H", data)[0]
+    mantissa = raw & 0x7FF
+    if raw & 0x8000:
+        mantissa -= 0x800
+    return mantissa * (1 << ((raw >> 11) & 0x0F)) / 100
+
+def group_address_str(address):
+    """16 bit group address -> '11/1/3'"""
+    return f"{address >> 11}/{(address >> 8) & 0x07}/{address & 0xFF}"
+
+class _KnxdHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        knxd = self.server.knxd
+        sock = self.request
+        knxd.connections += 1
+        with knxd.lock:
+            knxd.clients.add(sock)
+        try:
+            while True:
+                header = self._recv_exact(sock, 2)
+                if header is None:
+                    return
+                body = self._recv_exact(sock, struct.unpack(">H", header)[0])
+                if body is None or len(body) < 2:
+                    return
+                msg_type = struct.unpack(">H", body[:2])[0]
+                if msg_type == EIB_OPEN_GROUPCON:
+                    if knxd.faults.is_offline():
+                        return      # bus not available, the client gets a closed connection
+                    sock.sendall(struct.pack(">HH", 2, EIB_OPEN_GROUPCON))
+                elif msg_type == EIB_GROUP_PACKET and len(body) >= 6:
+                    if knxd.faults.lost():
+                        return      # connection drops, the packet is lost
+                    address, apdu = struct.unpack(">H", body[2:4])[0], body[4:]
+                    if apdu[1] & 0xC0 == APCI_GROUP_WRITE and len(apdu) == 4:
+                        knxd.writes.append((group_address_str(address), dpt9_bytes_to_float(apdu[2:]), time.monotonic()))
+        except OSError:
+            pass
+        finally:
+            with knxd.lock:
+                knxd.clients.discard(sock)
+
+    @staticmethod
+    def _recv_exact(sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+class FakeKnxd:
+    """Simulated knxd, speaks the group socket part of the knxd client protocol (EIB_OPEN_GROUPCON, EIB_GROUP_PACKET)
+    which knx.KNXSender uses. Every group write is recorded in writes as (group address, DPT 9 value, time).
+    drop() closes all client connections, to test the reconnect of the sender.
+    While offline (faults) group connections are refused, a lost packet drops the connection."""
+
+    def __init__(self, host="127.0.0.1", port=0, faults=NO_FAULTS):
+        self.faults = faults
+        self.writes = []
+        self.connections = 0
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer((host, port), _KnxdHandler)
+        self.server.daemon_threads = True
+        self.server.knxd = self
+        self.url = f"ip:{host}:{self.server.server_address[1]}"
+
+    def values(self):
+        """Last written value per group address."""
+        return {address: value for address, value, _ in self.writes}
+
+    def drop(self):
+        with self.lock:
+            clients = list(self.clients)
+        for sock in clients:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="sim-knxd", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.drop()
+        self.server.shutdown()
+        self.server.server_close()
+
+def check_sender():
+    """Runs knx.KNXSender against a FakeKnxd: change-only sending, deadband and reconnect after a dropped connection."""
+    from knx import KNXSender
+    from simulator.faults import Faults
+
+    def written(count):
+        # knxd receives the values asynchronously
+        deadline = time.monotonic() + 2.0
+        while len(knxd.writes) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return len(knxd.writes)
+
+    knxd = FakeKnxd().start()
+    try:
+        sender = KNXSender(knxd.url)
+        assert sender.send({"11/1/1": 1500.0, "11/1/2": 0.0}) == 2 and written(2) == 2
+        assert sender.send({"11/1/1": 1500.0, "11/1/2": 0.0}) == 0, "unchanged values were sent"
+        assert sender.send({"11/1/1": 1600.0, "11/1/2": 0.0}) == 1 and written(3) == 3
+
+        deadband = KNXSender(knxd.url, deadband=50.0)
+        assert deadband.send({"11/1/3": 1000.0}) == 1 and written(4) == 4
+        assert deadband.send({"11/1/3": 1040.0}) == 0, "change within the deadband was sent"
+        assert deadband.send({"11/1/3": 1060.0}) == 1 and written(5) == 5
+
+        # knxd closes the connection: the next value has to arrive through a new connection
+        knxd.drop()
+        time.sleep(0.1)
+        assert sender.send({"11/1/1": 2000.0}) == 1 and written(6) == 6, "value lost after the connection was dropped"
+        assert abs(knxd.values()["11/1/1"] - 2000.0) < 1.0 and knxd.connections == 3
+
+        # knxd refuses the connection: nothing counts as sent, the value goes out once knxd is back
+        knxd.faults = Faults(offline=(10, 10))
+        knxd.drop()
+        time.sleep(0.1)
+        try:
+            sender.send({"11/1/1": 2100.0})
+            raise AssertionError("send to an offline knxd did not fail")
+        except OSError:
+            pass
+        knxd.faults = NO_FAULTS
+        assert sender.send({"11/1/1": 2100.0}) == 1 and written(7) == 7
+        assert abs(knxd.values()["11/1/1"] - 2100.0) < 1.0
+    finally:
+        knxd.stop()
+    print("KNXSender against FakeKnxd: ok")
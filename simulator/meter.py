@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+from emeter2 import emeterPacket, emeterFrame
+from scheduler import PeriodicTask
+from simulator.faults import NO_FAULTS
+
+class FakeMeter:
+    """Simulated SMA Energy Meter, power in W (consume = from grid, supply = to grid).
+    The energy counters grow with the power."""
+
+    def __init__(self, serial=1900123456, consume=500.0, supply=0.0, consume_energy=1000.0, supply_energy=0.0,
+                 voltage=230.0, faults=NO_FAULTS):
+        self.serial = serial
+        self.voltage = voltage
+        self.consume = consume
+        self.supply = supply
+        self.consume_energy = consume_energy    # kWh
+        self.supply_energy = supply_energy      # kWh
+        self.faults = faults
+        self.frame = emeterFrame(serial)
+        self.last_update = time.monotonic()
+
+    def data(self):
+        """Current frame (None while offline or if the frame gets lost)."""
+        now = time.monotonic()
+        hours = (now - self.last_update) / 3600
+        self.last_update = now
+        self.consume_energy += self.consume * hours / 1000
+        self.supply_energy += self.supply * hours / 1000
+        if self.faults.is_offline(now) or self.faults.lost():
+            return None
+
+        frame = self.frame
+        frame.setTimestamp(int(time.time() * 1000))
+        frame.setMeasurementValue(emeterPacket.SMA_POSITIVE_ACTIVE_POWER, round(self.consume * 10))
+        frame.setCounterValue(emeterPacket.SMA_POSITIVE_ACTIVE_ENERGY, round(self.consume_energy * 1000 * 3600))
+        frame.setMeasurementValue(emeterPacket.SMA_NEGATIVE_ACTIVE_POWER, round(self.supply * 10))
+        frame.setCounterValue(emeterPacket.SMA_NEGATIVE_ACTIVE_ENERGY, round(self.supply_energy * 1000 * 3600))
+        frame.setMeasurementValue(emeterPacket.SMA_POSITIVE_APPARENT_POWER, round(self.consume * 10))
+        frame.setMeasurementValue(emeterPacket.SMA_NEGATIVE_APPARENT_POWER, round(self.supply * 10))
+        frame.setMeasurementValue(emeterPacket.SMA_POWER_FACTOR, 1000)
+        # load and feed-in evenly on all phases, power factor 1
+        for phase in ("_L1", "_L2", "_L3"):
+            consume, supply = self.consume / 3, self.supply / 3
+            frame.setMeasurementValue(getattr(emeterPacket, "SMA_POSITIVE_ACTIVE_POWER" + phase), round(consume * 10))
+            frame.setCounterValue(getattr(emeterPacket, "SMA_POSITIVE_ACTIVE_ENERGY" + phase), round(self.consume_energy / 3 * 1000 * 3600))
+            frame.setMeasurementValue(getattr(emeterPacket, "SMA_NEGATIVE_ACTIVE_POWER" + phase), round(supply * 10))
+            frame.setCounterValue(getattr(emeterPacket, "SMA_NEGATIVE_ACTIVE_ENERGY" + phase), round(self.supply_energy / 3 * 1000 * 3600))
+            frame.setMeasurementValue(getattr(emeterPacket, "SMA_POSITIVE_APPARENT_POWER" + phase), round(consume * 10))
+            frame.setMeasurementValue(getattr(emeterPacket, "SMA_NEGATIVE_APPARENT_POWER" + phase), round(supply * 10))
+            frame.setMeasurementValue(getattr(emeterPacket, "SMA_VOLTAGE" + phase), round(self.voltage * 1000))
+            frame.setMeasurementValue(getattr(emeterPacket, "SMA_CURRENT" + phase), round(max(consume, supply) / self.voltage * 1000))
+            frame.setMeasurementValue(getattr(emeterPacket, "SMA_POWER_FACTOR" + phase), 1000)
+        return frame.getData()
+
+class MeterFarm(PeriodicTask):
+    """Sends the frames of all FakeMeters every <interval> seconds (a real meter sends every second),
+    by default to the SMA multicast group. Latency settings of the meters are not used."""
+
+    def __init__(self, meters, target=("239.12.255.254", 9522), interval=1.0):
+        super().__init__(interval, self.send, name="sim-meters")
+        self.meters = list(meters)
+        self.target = target
+        self.sent = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+    def send(self):
+        for meter in self.meters:
+            data = meter.data()
+            if data is not None:
+                self.sock.sendto(data, self.target)
+                self.sent += 1
+
+    def stop(self):
+        super().stop()
+        self.sock.close()
@@ -3,6 +3,8 @@ import time
 from struct import *
 import socket
 import logging
+import queue
+import threading
 
 MY_SYSTEMID    = 0x00ED                # random number, has to be different from any device in local network
 MY_SERIAL      = 0x23021922            # random number, has to be different from any device in local network
@@ -10,9 +12,14 @@ ANY_SYSTEMID   = 0xFFFF                # 0xFFFF is any susyid
 ANY_SERIAL     = 0xFFFFFFFF            # 0xFFFFFFFF is any serialnumber
 SMA_PKT_HEADER = "534D4100000402A000000001"
 SMA_ESIGNATURE = "00106065"
+PKT_OFFSET_LENGTH = 12                 # offsets in request packets
+PKT_OFFSET_PKT_ID = 40
+PKT_OFFSET_DATA = 54
+SESSION_TIMEOUT = 300                  # seconds without answer after which a kept session is considered expired
 
-# UDP_IPB = "239.12.255.254"
-# MESSAGE = bytes.fromhex('534d4100000402a0ffffffff0000002000000000')
+DISCOVERY_GROUP = "239.12.255.254"   # speedwire multicast group, devices answer the discovery request by unicast
+DISCOVERY_PORT = 9522
+DISCOVERY_REQUEST = bytes.fromhex('534d4100000402a0ffffffff0000002000000000')
 
 COMMAND_LIST = {
     # name,           [command,    first,      last      ]
@@ -21,6 +28,53 @@ COMMAND_LIST = {
     "info":           [0x58000200, 0x00821E00, 0x008220FF],
     "energy":         [0x54000200, 0x00260100, 0x002622FF],
     "power_ac_total": [0x51000200, 0x00263F00, 0x00263FFF],
+    # wide ranges, one request each answered with many records
+    "spot_ac":        [0x51000200, 0x00263F00, 0x004657FF],   # AC total power, power/voltage/current per phase, grid frequency
+    "spot_dc":        [0x53800200, 0x00251E00, 0x004521FF],   # DC power, voltage and current per string
+    "status":         [0x51800200, 0x00214800, 0x004164FF],   # device status, grid relay
+}
+
+# Commands fetched by update() if not set otherwise
+DATA_COMMANDS = ("energy", "spot_ac")
+
+RECORD_OFFSET = 54                     # first record in answers
+KEEP = object()                        # marker for sensors which keep their last value if the inverter reports none
+
+# Records of data answers, code (LRI) -> sensor, name, unit, factor, value if the inverter reports none (NaN).
+# "{}" in sensor and name is replaced by the record index (string number of DC values).
+RECORDS = {
+    0x2601: ("energy_total",   "Energy Production Total", "kWh", 0.001, KEEP),
+    0x2622: ("energy_today",   "Energy Production Today", "kWh", 0.001, KEEP),
+    0x263F: ("power_ac_total", "Power Production Now",    "W",   1,     0),
+    0x4640: ("power_ac_l1",    "Power L1",                "W",   1,     0),
+    0x4641: ("power_ac_l2",    "Power L2",                "W",   1,     0),
+    0x4642: ("power_ac_l3",    "Power L3",                "W",   1,     0),
+    0x4648: ("voltage_ac_l1",  "Voltage L1",              "V",   0.01,  None),
+    0x4649: ("voltage_ac_l2",  "Voltage L2",              "V",   0.01,  None),
+    0x464A: ("voltage_ac_l3",  "Voltage L3",              "V",   0.01,  None),
+    0x4653: ("current_ac_l1",  "Current L1",              "A",   0.001, 0),
+    0x4654: ("current_ac_l2",  "Current L2",              "A",   0.001, 0),
+    0x4655: ("current_ac_l3",  "Current L3",              "A",   0.001, 0),
+    0x4657: ("frequency",      "Grid Frequency",          "Hz",  0.01,  None),
+    0x251E: ("power_dc_{}",    "DC Power String {}",      "W",   1,     0),
+    0x451F: ("voltage_dc_{}",  "DC Voltage String {}",    "V",   0.01,  None),
+    0x4521: ("current_dc_{}",  "DC Current String {}",    "A",   0.001, 0),
+    0x2148: ("status",         "Device Status",           "",    None,  None),
+    0x4164: ("grid_relay",     "Grid Relay",              "",    None,  None),
+}
+
+RECORD_TYPE_STATUS = 0x08
+RECORD_TYPE_STRING = 0x10
+RECORD_TYPE_SIGNED = 0x40
+
+SMA_STATUS = {
+    35: "Fault",
+    51: "Closed",
+    303: "Off",
+    307: "Ok",
+    311: "Open",
+    455: "Warning",
+    16777213: "Information not available",
 }
 
 SMA_INV_TYPE = {
@@ -175,40 +229,132 @@ SMA_INV_CLASS = {
 class smaError(Exception):
     pass
 
+class smaResponseError(smaError):
+    """The inverter answered with an error code (e.g. the session is no longer valid)."""
+
+def discover(timeout=2.0, interface="0.0.0.0", group=DISCOVERY_GROUP, port=DISCOVERY_PORT, logger=None):
+    """Sends the speedwire discovery request, returns the IPs of all devices which answer within timeout seconds."""
+    logger = logger or logging.getLogger(__name__)
+    found = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        if interface != "0.0.0.0":
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        sock.bind((interface, 0))
+        sock.sendto(DISCOVERY_REQUEST, (group, port))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, addr = sock.recvfrom(2048)
+            except TimeoutError:
+                break
+            if data[:4] == b"SMA\0" and addr[0] not in found:
+                logger.debug("Discovery answer from %s" % addr[0])
+                found.append(addr[0])
+    finally:
+        sock.close()
+    return found
+
+def iter_records(data):
+    """Yields (code, index, value) of every record of a data answer. All records of an answer have the same size,
+    16 bytes for 64 bit counters, 28 bytes for 32 bit values and 40 bytes for status/attribute lists.
+    value is None if the inverter has no value (NaN), strings are skipped."""
+    end = min(len(data), 18 + 4 * data[18])                                                            # length in 4 byte words after offset 18
+    if end <= RECORD_OFFSET:
+        return
+    first, last = unpack_from("<II", data, 46)                                                          # record numbers
+    count = last - first + 1
+    if count <= 0:
+        return
+    size = (end - RECORD_OFFSET) // count
+    if size < 16:
+        raise smaError("Format of inverter response does not fit.")
+    for i in range(RECORD_OFFSET, RECORD_OFFSET + count * size, size):
+        index, code, kind = unpack_from("<BHB", data, i)
+        if kind == RECORD_TYPE_STRING:
+            continue
+        if size == 16:
+            value = unpack_from("<Q", data, i + 8)[0]
+            if value in (0x8000000000000000, 0xFFFFFFFFFFFFFFFF):
+                value = None
+        elif kind == RECORD_TYPE_STATUS:
+            value = None
+            for j in range(i + 8, i + size, 4):
+                attribute = unpack_from("<I", data, j)[0]
+                if attribute == 0x00FFFFFE:                                                             # end of attributes
+                    break
+                if attribute >> 24 == 1:                                                                # selected attribute
+                    value = attribute & 0x00FFFFFF
+                    break
+        elif kind == RECORD_TYPE_SIGNED:
+            value = unpack_from("<i", data, i + 8)[0]
+            if value == -0x80000000:
+                value = None
+        else:
+            value = unpack_from("<I", data, i + 8)[0]
+            if value in (0x80000000, 0xFFFFFFFF):
+                value = None
+        yield code, index, value
+
 class SMA_SPEEDWIRE:
-    def __init__(self, host, password="0000", logger=None):
+    def __init__(self, host, password="0000", logger=None, session=False, session_timeout=SESSION_TIMEOUT, transport=None,
+                 commands=DATA_COMMANDS):
         self.host = host
         self.port = 9522
+        self.transport = transport              # shared SpeedwireTransport, None = own socket
         self.password = password
         self.pkt_id = 0
         self.my_id = MY_SYSTEMID.to_bytes(2, byteorder='little') + MY_SERIAL.to_bytes(4, byteorder='little')
         self.target_id = ANY_SYSTEMID.to_bytes(2, byteorder='little') + ANY_SERIAL.to_bytes(4, byteorder='little')
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.settimeout(3.0)
+        self.timeout = 3.0
         self.retry = 2
+        self.sock = self._socket()
+        self.session = session                  # keep logged in between updates, logout only on close()
+        self.session_timeout = session_timeout
+        self.commands = tuple(commands)         # data requests of every update, see COMMAND_LIST
+        self.logged_in = False
+        self.last_answer = 0.0                  # time.monotonic() of last valid answer
+        self.round_trips = 0                    # number of packets sent to the inverter
+        self.timeouts = 0                       # number of requests without answer
+        self.retries = 0                        # number of requests sent again after a timeout
+        self._templates = {}                    # command -> prebuilt request, see _packet()
+        self.recorder = None                    # function(host, data), called with every answer (see capture.py)
 
         self.serial = None
+        self.susyid = None
         self.inv_class = None
         self.inv_type = None
         self.sensors = {
-            "energy_total":   {"name":"Energy Production Total","value":None,"unit":"kWh"},
-            "energy_today":   {"name":"Energy Production Today","value":None,"unit":"kWh"},
-            "power_ac_total": {"name":"Power Production Now","value":None,"unit":"W"},
+            sensor: {"name":name,"value":None,"unit":unit}
+            for sensor, name, unit, _, _ in RECORDS.values() if "{}" not in sensor
         }
 
         if logger:
             self.logger = logger
         else:
             self.logger = logging.getLogger(__name__)
-            self.logger.setLevel(logging.INFO)
-            ch = logging.StreamHandler()
-            ch.setLevel(logging.DEBUG)
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            ch.setFormatter(formatter)
-            self.logger.addHandler(ch)
+            if not self.logger.handlers:
+                # the module logger is shared by all devices, add its handler only once
+                self.logger.setLevel(logging.INFO)
+                ch = logging.StreamHandler()
+                ch.setLevel(logging.DEBUG)
+                formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+                ch.setFormatter(formatter)
+                self.logger.addHandler(ch)
+
+    def _socket(self):
+        if self.transport:
+            return None
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        return sock
         
-    def _packet(self, cmd):
-        self.pkt_id += 1                                                                                # increase packet counter
+    def _build_packet(self, cmd):
         commands = COMMAND_LIST[cmd]
         sep2 = bytes([0x00, 0x00])                                                                      # separator for default commands
         sep4 = bytes([0x00, 0x00, 0x00, 0x00])
@@ -220,7 +366,7 @@ class SMA_SPEEDWIRE:
             esignature = bytes.fromhex(SMA_ESIGNATURE + "0EA0")
             encpasswd = [0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88, 0x88]
             encpasswd[0:len(self.password)] = [((0x88 + ord(char)) & 0xff) for char in self.password]   # encode password
-            data = int(time.time()).to_bytes(4, byteorder='little')                                     # timestamp utc
+            data = sep4                                                                                 # placeholder timestamp
             data += sep4 + bytes(encpasswd) + sep4                                                      # setarator4 + password + setarator4
         elif cmd == "logout":
             sep2 = bytes([0x00, 0x03])                                                                  # separator for logout
@@ -229,15 +375,27 @@ class SMA_SPEEDWIRE:
 
         msg = bytes.fromhex(SMA_PKT_HEADER) + bytes([0x00, 0x00]) + esignature                          # header + placeholder len + signature
         msg += self.target_id + sep2 + self.my_id + sep2                                                # targets and my address
-        msg += sep4 + (self.pkt_id | 0x8000).to_bytes(2, byteorder='little')                            # packet counter
+        msg += sep4 + bytes([0x00, 0x00])                                                               # placeholder packet counter
         msg += commands[0].to_bytes(4, byteorder='little')                                              # command + first + last
         msg += commands[1].to_bytes(4, byteorder='little')
         msg += commands[2].to_bytes(4, byteorder='little')
         msg += data                                                                                     # data
-        pkt_len = (len(msg)-20).to_bytes(2, byteorder='big')                                            # calculate packet length
-        msg = msg[:12] + pkt_len + msg[14:]                                                             # insert packet length
+        msg = bytearray(msg)
+        pack_into(">H", msg, PKT_OFFSET_LENGTH, len(msg) - 20)                                          # insert packet length
+        return msg
 
-        self.logger.debug("> %s", msg.hex())
+    def _packet(self, cmd):
+        # requests are built once per command and target, afterwards only the counter (and login time) change
+        self.pkt_id = (self.pkt_id + 1) & 0x7FFF                                                        # increase packet counter
+        msg = self._templates.get(cmd)
+        if msg is None:
+            msg = self._templates[cmd] = self._build_packet(cmd)
+        pack_into("<H", msg, PKT_OFFSET_PKT_ID, self.pkt_id | 0x8000)                                   # packet counter
+        if cmd == "login":
+            pack_into("<I", msg, PKT_OFFSET_DATA, int(time.time()))                                     # timestamp utc
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("> %s", msg.hex())
         return msg
 
     def _send_recieve(self, cmd, receive=True):
@@ -246,49 +404,78 @@ class SMA_SPEEDWIRE:
             repeat += 1
             try:
                 msg = self._packet(cmd)
+                self.round_trips += 1
+                if self.transport:
+                    if not receive:
+                        self.transport.send(self.host, self.port, msg)
+                        return
+                    data = self.transport.request(self.host, self.port, self.pkt_id, msg, self.timeout)
+                    return self._check_response(data)
                 self.sock.sendto(msg, (self.host, self.port))
                 if not receive:
                     return
-                data, address = self.sock.recvfrom(300)
-                self.logger.debug("< %s", data.hex())
-                size = len(data)
-                if size > 42:
-                    pkt_id = unpack_from("H", data, offset=40)[0]
-                    error = unpack_from("I", data, offset=36)[0]
-                    pkt_id &= 0x7FFF
-                    # if (pkt_id != self.pkt_id) or (error != 0):
-                    if error != 0:
-                        self.logger.debug("Req/Rsp: Packet ID %X/%X, Error %d" % (self.pkt_id, pkt_id, error))
-                        raise smaError("Inverter answer does not match our parameters.")
-                    if (pkt_id != self.pkt_id):
-                        self.pkt_id = pkt_id
-                else:
-                    raise smaError("Format of inverter response does not fit.")
-                return data
+                data, address = self.sock.recvfrom(2048)
+                return self._check_response(data)
             except TimeoutError as e:
                 self.logger.error("Timeout")
-                # pass
+                self.timeouts += 1
+                if repeat < self.retry:
+                    self.retries += 1
                 continue
 
-            raise smaError("No response")
+        raise smaError("No response")
+
+    def _check_response(self, data):
+        if self.recorder:
+            self.recorder(self.host, data)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("< %s", data.hex())
+        size = len(data)
+        if size > 42:
+            pkt_id = unpack_from("H", data, offset=40)[0]
+            error = unpack_from("I", data, offset=36)[0]
+            pkt_id &= 0x7FFF
+            # if (pkt_id != self.pkt_id) or (error != 0):
+            if error != 0:
+                self.logger.debug("Req/Rsp: Packet ID %X/%X, Error %d" % (self.pkt_id, pkt_id, error))
+                raise smaResponseError("Inverter answer does not match our parameters.")
+            if (pkt_id != self.pkt_id):
+                self.pkt_id = pkt_id
+        else:
+            raise smaError("Format of inverter response does not fit.")
+        self.last_answer = time.monotonic()
+        return data
 
     def _login(self):
-        data = self._send_recieve("login")
+        return self._handle_login(self._send_recieve("login"))
+
+    def _handle_login(self, data):
         if data:
             inv_susyid, inv_serial = unpack_from("<HI", data, offset=28)
             self.serial = inv_serial
-            self.target_id = inv_susyid.to_bytes(2, byteorder='little') + inv_serial.to_bytes(4, byteorder='little')
+            self.susyid = inv_susyid
+            target_id = inv_susyid.to_bytes(2, byteorder='little') + inv_serial.to_bytes(4, byteorder='little')
+            if target_id != self.target_id:
+                self.target_id = target_id
+                self._templates.clear()
             self.logger.debug("Logged in to inverter susyid: %d, serial: %d" % (inv_susyid, inv_serial))
+            self.logged_in = True
             return True
         return False
 
     def _logout(self):
+        self.logged_in = False
         self._send_recieve("logout", False)
         self.pkt_id = 0
         return True
 
+    def _session_valid(self):
+        return self.logged_in and (time.monotonic() - self.last_answer) < self.session_timeout
+
     def _fetch(self, command):
-        data = self._send_recieve(command)
+        self._parse(self._send_recieve(command))
+
+    def _parse(self, data):
         data_len = len(data)
         if data:
             cmd = unpack_from("H", data, offset=55)[0]
@@ -308,30 +495,162 @@ class SMA_SPEEDWIRE:
                     self.inv_class = SMA_INV_CLASS[inv_class]
                 if inv_type in SMA_INV_TYPE:
                     self.inv_type = SMA_INV_TYPE[inv_type]
-                    
-            elif cmd == 0x2601:
-                if data_len >= 66:
-                    value = unpack_from("I", data, offset=62)[0]
-                    if (value != 0x80000000) and (value != 0xFFFFFFFF) and (value > 0):
-                        self.sensors['energy_total']['value'] = value / 1000
-                if data_len >= 82:
-                    value = unpack_from("I", data, offset=78)[0]
-                    self.sensors['energy_today']['value'] = value / 1000
-
-            elif cmd == 0x263F:
-                value = unpack_from("I", data, offset=62)[0]
-                if (value == 0x80000000):
-                    value = 0
-                self.sensors['power_ac_total']['value'] = value
-            return
+                return
+            self._parse_records(data)
+
+    def _parse_records(self, data):
+        for code, index, value in iter_records(data):
+            record = RECORDS.get(code)
+            if record is None:
+                continue
+            sensor, name, unit, factor, missing = record
+            if value is None or (value == 0 and sensor == "energy_total"):                             # a total of 0 is never valid
+                if missing is KEEP:
+                    continue
+                value = missing
+            elif factor is None:
+                value = SMA_STATUS.get(value, str(value))
+            elif factor != 1:
+                value = round(value * factor, 3)
+            if "{}" in sensor:
+                sensor = sensor.format(index)
+                if sensor not in self.sensors:
+                    self.sensors[sensor] = {"name":name.format(index),"value":None,"unit":unit}
+            self.sensors[sensor]["value"] = value
 
     def init(self):
         self._login()
         self._fetch("info")
-        self._logout()
+        if not self.session:
+            self._logout()
+
+    def restore(self, info):
+        """Takes serial, susyid, inv_type and inv_class from an earlier init() (dict, see device_registry) instead of
+        asking the device. The device is addressed by its serial after the first login, like after init()."""
+        self.serial = info.get("serial")
+        self.susyid = info.get("susyid")
+        self.inv_type = info.get("inv_type")
+        self.inv_class = info.get("inv_class")
     
+    def _fetch_all(self):
+        for command in self.commands:
+            self._fetch(command)
+
     def update(self):
-        self._login()
-        self._fetch("energy")
-        self._fetch("power_ac_total")
-        self._logout()
+        if not self.session:
+            self._login()
+            self._fetch_all()
+            self._logout()
+            return
+
+        relogin = not self._session_valid()
+        if relogin:
+            self._login()
+        try:
+            self._fetch_all()
+        except smaResponseError:
+            # timeouts are raised right away, only an error answer means the session may be gone
+            self.logged_in = False
+            if relogin:
+                raise
+            # session may have been dropped by the inverter, login again once
+            self.logger.debug("Session of %s lost, login again" % self.host)
+            self._login()
+            self._fetch_all()
+
+    def close(self):
+        if self.logged_in:
+            try:
+                self._logout()
+            except (smaError, OSError) as e:
+                self.logger.debug("Logout from %s failed: %s" % (self.host, e))
+        if self.sock:
+            self.sock.close()
+
+
+def _answer_key(data, addr):
+    # key an answer is matched with: ((ip, port), packet id at offset 40)
+    if len(data) <= 42:
+        return None
+    return (addr[:2], unpack_from("H", data, offset=40)[0] & 0x7FFF)
+
+class SpeedwireTransport:
+    """One UDP socket shared by all SMA_SPEEDWIRE clients (pass as transport=).
+    A sender thread works off the send queue, a receiver thread hands every answer to the
+    request waiting for (source address, packet id). Hosts have to be IP addresses."""
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("0.0.0.0", 0))
+        self.sock.settimeout(1.0)
+        self.send_queue = queue.Queue()
+        self.requests = {}  # ((host, port), pkt_id) -> [event, answer]
+        self.lock = threading.Lock()
+        self.running = True
+        self.sender = threading.Thread(target=self._send_loop, name="speedwire-send", daemon=True)
+        self.receiver = threading.Thread(target=self._receive_loop, name="speedwire-recv", daemon=True)
+        self.sender.start()
+        self.receiver.start()
+
+    def _send_loop(self):
+        while True:
+            item = self.send_queue.get()
+            if item is None:
+                return
+            msg, addr = item
+            try:
+                self.sock.sendto(msg, addr)
+            except OSError as e:
+                self.logger.debug("Sending to %s failed: %s" % (addr[0], e))
+
+    def _receive_loop(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except TimeoutError:
+                continue
+            except OSError:
+                return
+            key = _answer_key(data, addr)
+            if key is None:
+                continue
+            with self.lock:
+                slot = self.requests.pop(key, None)
+            if slot is None:
+                self.logger.debug("Dropping unexpected answer from %s, packet id %X" % (addr[0], key[1]))
+                continue
+            slot[1] = data
+            slot[0].set()
+
+    def send(self, host, port, msg):
+        self.send_queue.put((bytes(msg), (host, port)))
+
+    def request(self, host, port, pkt_id, msg, timeout):
+        key = ((host, port), pkt_id)
+        slot = [threading.Event(), None]
+        with self.lock:
+            self.requests[key] = slot
+        self.send(host, port, msg)
+        if not slot[0].wait(timeout):
+            with self.lock:
+                if self.requests.get(key) is slot:
+                    del self.requests[key]
+            raise TimeoutError("No answer from %s" % host)
+        return slot[1]
+
+    def close(self):
+        self.running = False
+        self.send_queue.put(None)
+        self.sender.join(1.0)
+        self.receiver.join(2.0)
+        self.sock.close()
+
+# The asyncio variant lives in sma_speedwire_async, asyncio is only imported when it is used
+_ASYNC_NAMES = ("SpeedwireProtocol", "create_speedwire_protocol", "SMA_SPEEDWIRE_ASYNC")
+
+def __getattr__(name):
+    if name in _ASYNC_NAMES:
+        import sma_speedwire_async
+        return getattr(sma_speedwire_async, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
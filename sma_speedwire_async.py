@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from sma_speedwire import SMA_SPEEDWIRE, SESSION_TIMEOUT, DATA_COMMANDS, smaError, smaResponseError, _answer_key
+
+class SpeedwireProtocol(asyncio.DatagramProtocol):
+    """One UDP endpoint shared by any number of SMA_SPEEDWIRE_ASYNC clients.
+    Answers are matched to the waiting request by (source address, packet id at offset 40),
+    late answers of earlier requests are dropped."""
+
+    def __init__(self, logger=None):
+        self.transport = None
+        self.requests = {}  # ((host, port), pkt_id) -> future
+        self.logger = logger or logging.getLogger(__name__)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        key = _answer_key(data, addr)
+        if key is None:
+            return
+        future = self.requests.pop(key, None)
+        if future is None:
+            self.logger.debug("Dropping unexpected answer from %s, packet id %X" % (addr[0], key[1]))
+        elif not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        self.logger.debug("Speedwire socket error: %s" % exc)
+
+    def send(self, host, port, msg):
+        self.transport.sendto(msg, (host, port))
+
+    async def request(self, host, port, pkt_id, msg, timeout):
+        key = ((host, port), pkt_id)
+        future = asyncio.get_running_loop().create_future()
+        self.requests[key] = future
+        self.transport.sendto(msg, (host, port))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if self.requests.get(key) is future:
+                del self.requests[key]
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+async def create_speedwire_protocol(logger=None):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(lambda: SpeedwireProtocol(logger), local_addr=("0.0.0.0", 0))
+    return protocol
+
+class SMA_SPEEDWIRE_ASYNC(SMA_SPEEDWIRE):
+    """asyncio variant of SMA_SPEEDWIRE, all I/O goes through a shared SpeedwireProtocol.
+    host has to be an IP address, answers are matched by their source address."""
+
+    def __init__(self, host, protocol, password="0000", logger=None, session=False, session_timeout=SESSION_TIMEOUT,
+                 commands=DATA_COMMANDS):
+        self.protocol = protocol
+        super().__init__(host, password, logger, session, session_timeout, commands=commands)
+
+    def _socket(self):
+        return None
+
+    async def _send_recieve(self, cmd, receive=True):
+        repeat = 0
+        while repeat < self.retry:
+            repeat += 1
+            msg = self._packet(cmd)
+            self.round_trips += 1
+            if not receive:
+                self.protocol.send(self.host, self.port, msg)
+                return
+            try:
+                data = await self.protocol.request(self.host, self.port, self.pkt_id, msg, self.timeout)
+            except asyncio.TimeoutError:
+                self.logger.error("Timeout")
+                self.timeouts += 1
+                if repeat < self.retry:
+                    self.retries += 1
+                continue
+            return self._check_response(data)
+
+        raise smaError("No response")
+
+    async def _login(self):
+        return self._handle_login(await self._send_recieve("login"))
+
+    async def _logout(self):
+        self.logged_in = False
+        await self._send_recieve("logout", False)
+        self.pkt_id = 0
+        return True
+
+    async def _fetch(self, command):
+        self._parse(await self._send_recieve(command))
+
+    async def init(self):
+        await self._login()
+        await self._fetch("info")
+        if not self.session:
+            await self._logout()
+
+    async def _fetch_all(self):
+        for command in self.commands:
+            await self._fetch(command)
+
+    async def update(self):
+        if not self.session:
+            await self._login()
+            await self._fetch_all()
+            await self._logout()
+            return
+
+        relogin = not self._session_valid()
+        if relogin:
+            await self._login()
+        try:
+            await self._fetch_all()
+        except smaResponseError:
+            # timeouts are raised right away, only an error answer means the session may be gone
+            self.logged_in = False
+            if relogin:
+                raise
+            # session may have been dropped by the inverter, login again once
+            self.logger.debug("Session of %s lost, login again" % self.host)
+            await self._login()
+            await self._fetch_all()
+
+    async def close(self):
+        if self.logged_in:
+            try:
+                await self._logout()
+            except (smaError, OSError) as e:
+                self.logger.debug("Logout from %s failed: %s" % (self.host, e))
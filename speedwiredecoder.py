@@ -18,6 +18,7 @@
 """
 
 import binascii
+import struct
 
 # unit definitions with scaling
 sma_units={
@@ -95,74 +96,102 @@ def decode_OBIS(obis):
 #  print(f"Decoded OBIS: {measurement}, raw_type: {raw_type}")
   return (measurement,datatype)
 
-def decode_speedwire(datagram):
+# lookup tables for decode_speedwire, key is the OBIS header without tariff byte: (measurement<<8)|type
+# value: (size, unpack function, name, unit name, unit, divisor)
+_U32=struct.Struct('>I')
+_U64=struct.Struct('>Q')
+_VERSION=-1
+_tables={}
+
+def _build_table(channels):
+  table={}
+  for measurement,channel in sma_channels.items():
+    name=channel[0]
+    if measurement==36864:
+      if channels is None or name in channels:
+        table[measurement<<8]=(8,_VERSION,name,None,None,None)
+      continue
+    if channels is None or name in channels:
+      table[(measurement<<8)|4]=(8,_U32.unpack_from,name,name+'unit',channel[1],sma_units[channel[1]])
+    if len(channel)>2 and (channels is None or name+'counter' in channels):
+      table[(measurement<<8)|8]=(12,_U64.unpack_from,name+'counter',name+'counterunit',channel[2],sma_units[channel[2]])
+  return table
+
+def _get_table(channels):
+  key=None if channels is None else frozenset(channels)
+  table=_tables.get(key)
+  if table is None:
+    table=_tables[key]=_build_table(key)
+  return table
+
+def decode_version(value):
+  bversion=(binascii.b2a_hex(value).decode("utf-8"))
+  version=str(int(bversion[0:2],16))+"."+str(int(bversion[2:4],16))+"."+str(int(bversion[4:6],16))
+  revision=str(chr(int(bversion[6:8])))
+  #revision definitions
+  if revision=="1":
+      #S – Spezial Version
+      version=version+".S"
+  elif revision=="2":
+      #A – Alpha (noch kein Feature Complete, Version für Verifizierung und Validierung)
+      version=version+".A"
+  elif revision=="3":
+      #B – Beta (Feature Complete, Version für Verifizierung und Validierung)
+      version=version+".B"
+  elif revision=="4":
+      #R – Release Candidate / Release (Version für Verifizierung, Validierung und Feldtest / öffentliche Version)
+      version=version+".R"
+  elif revision=="5":
+      #E – Experimental Version (dient zur lokalen Verifizierung)
+      version=version+".E"
+  elif revision=="6":
+      #N – Keine Revision
+      version=version+".N"
+  #adding versionnumber to compare versions
+  version=version+"|"+str(bversion[0:2])+str(bversion[2:4])+str(bversion[4:6])
+  return version
+
+def speedwire_serial(datagram):
+  # cheap header check: serial number of an energy meter frame or None, without decoding the values
+  if len(datagram)<28 or datagram[0:3]!=b'SMA':
+    return None
+  return _U32.unpack_from(datagram,20)[0]
+
+def decode_speedwire(datagram, channels=None):
+  # channels: optional set of wanted emparts names (e.g. {'psupply','psupplycounter'}),
+  # all other values are skipped without decoding, 'serial' is always returned
   emparts={}
   # process data only of SMA header is present
-  if datagram[0:3]==b'SMA':
-    # datagram length
-    datalength=int.from_bytes(datagram[12:14],byteorder='big')+16
-    #print('data lenght: {}'.format(datalength))
-    if datalength != 54:
-      # serial number
-      emID=int.from_bytes(datagram[20:24],byteorder='big')
-      #print('seral: {}'.format(emID))
-      emparts['serial']=emID
-      # timestamp
-      timestamp=int.from_bytes(datagram[24:28],byteorder='big')
-      #print('timestamp: {}'.format(timestamp))
-      # decode OBIS data blocks
-      # start with header
-      position=28
-      while position<datalength:
-        # decode header
-        #print('pos: {}'.format(position))
-#        print(f"Decode position {position}: {binascii.hexlify(datagram[position:position+8])}")
-        (measurement,datatype)=decode_OBIS(datagram[position:position+4])
-        #print('measurement {} datatype: {}'.format(measurement,datatype))
-        # decode values
-        # actual values
-        if datatype=='actual':
-          value=int.from_bytes( datagram[position+4:position+8], byteorder='big' )
-          position+=8
-          if measurement in sma_channels.keys():
-            emparts[sma_channels[measurement][0]]=value/sma_units[sma_channels[measurement][1]]
-            emparts[sma_channels[measurement][0]+'unit']=sma_channels[measurement][1]
-        # counter values
-        elif datatype=='counter':
-          value=int.from_bytes( datagram[position+4:position+12], byteorder='big' )
-          position+=12
-          if measurement in sma_channels.keys():
-            emparts[sma_channels[measurement][0]+'counter']=value/sma_units[sma_channels[measurement][2]]
-            emparts[sma_channels[measurement][0]+'counterunit']=sma_channels[measurement][2]
-        elif datatype=='version':
-          value=datagram[position+4:position+8]
-          if measurement in sma_channels.keys():
-            bversion=(binascii.b2a_hex(value).decode("utf-8"))
-            version=str(int(bversion[0:2],16))+"."+str(int(bversion[2:4],16))+"."+str(int(bversion[4:6],16))
-            revision=str(chr(int(bversion[6:8])))
-            #revision definitions
-            if revision=="1":
-                #S – Spezial Version
-                version=version+".S"
-            elif revision=="2":
-                #A – Alpha (noch kein Feature Complete, Version für Verifizierung und Validierung)
-                version=version+".A"
-            elif revision=="3":
-                #B – Beta (Feature Complete, Version für Verifizierung und Validierung)
-                version=version+".B"
-            elif revision=="4":
-                #R – Release Candidate / Release (Version für Verifizierung, Validierung und Feldtest / öffentliche Version)
-                version=version+".R"
-            elif revision=="5":
-                #E – Experimental Version (dient zur lokalen Verifizierung)
-                version=version+".E"
-            elif revision=="6":
-                #N – Keine Revision
-                version=version+".N"
-            #adding versionnumber to compare versions
-            version=version+"|"+str(bversion[0:2])+str(bversion[2:4])+str(bversion[4:6])
-            emparts[sma_channels[measurement][0]]=version
-          position+=8
-        else:
-          position+=8
+  if datagram[0:3]!=b'SMA' or len(datagram)<28:
+    return emparts
+  # datagram length
+  datalength=_U32.unpack_from(datagram,10)[0]&0xFFFF
+  if datalength+16==54:
+    return emparts
+  end=min(datalength+16,len(datagram))
+  # serial number
+  emparts['serial']=_U32.unpack_from(datagram,20)[0]
+  table=_get_table(channels)
+  missing=len(table) if channels is not None else -1
+  # decode OBIS data blocks, start after header
+  position=28
+  while position+8<=end:
+    key=_U32.unpack_from(datagram,position)[0]>>8
+    entry=table.get(key)
+    if entry is None:
+      # unwanted or unknown channel, counters have 8 bytes value, all others 4
+      position+=12 if key&0xFF==8 else 8
+      continue
+    size,unpack,name,unitname,unit,divisor=entry
+    if position+size>end:
+      break
+    if unpack is _VERSION:
+      emparts[name]=decode_version(datagram[position+4:position+8])
+    else:
+      emparts[name]=unpack(datagram,position+4)[0]/divisor
+      emparts[unitname]=unit
+    position+=size
+    missing-=1
+    if missing==0:
+      break
   return emparts